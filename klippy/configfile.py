@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, os, glob, re, time, logging, configparser, io
+import sys, os, glob, re, time, logging, configparser, io, hashlib
 
 error = configparser.Error
 
@@ -128,22 +128,44 @@ class ConfigWrapper:
         pconfig = self.printer.lookup_object("configfile")
         pconfig.deprecate(self.section, option, value, msg)
 
+# Time without calls to set() before the pending changes are reported
+SET_REPORT_DELAY = 1.
+
 AUTOSAVE_HEADER = """
 #*# <---------------------- SAVE_CONFIG ---------------------->
 #*# DO NOT EDIT THIS BLOCK OR BELOW. The contents are auto-generated.
 #*#
 """
 
+# Parsed config files are cached (across printer restarts) along with
+# the contents hash of every file read and the result of every include
+# glob used to build them.
+parse_cache = {}
+
+def _get_data_hash(data):
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+def _snapshot_fileconfig(fileconfig):
+    return [(section, [(option, fileconfig.get(section, option))
+                       for option in fileconfig.options(section)])
+            for section in fileconfig.sections()]
+
 class PrinterConfig:
     def __init__(self, printer):
         self.printer = printer
         self.autosave = None
+        self.parse_deps = None
         self.deprecated = {}
         self.status_raw_config = {}
         self.status_save_pending = {}
         self.status_settings = {}
         self.status_warnings = []
         self.save_config_pending = False
+        self.pending_sets = {}
+        self.pending_status_sets = {}
+        reactor = self.printer.get_reactor()
+        self.pending_sets_timer = reactor.register_timer(
+            self._report_pending_sets)
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command("SAVE_CONFIG", self.cmd_SAVE_CONFIG,
                                desc=self.cmd_SAVE_CONFIG_help)
@@ -158,7 +180,10 @@ class PrinterConfig:
             msg = "Unable to open config file %s" % (filename,)
             logging.exception(msg)
             raise error(msg)
-        return data.replace('\r\n', '\n')
+        data = data.replace('\r\n', '\n')
+        if self.parse_deps is not None:
+            self.parse_deps.append(('file', filename, _get_data_hash(data)))
+        return data
     def _find_autosave_data(self, data):
         regular_data = data
         autosave_data = ""
@@ -224,6 +249,9 @@ class PrinterConfig:
             # Empty set is OK if wildcard but not for direct file reference
             raise error("Include file '%s' does not exist" % (include_glob,))
         include_filenames.sort()
+        if self.parse_deps is not None:
+            self.parse_deps.append(('glob', include_glob,
+                                    tuple(include_filenames)))
         for include_filename in include_filenames:
             include_data = self._read_config_file(include_filename)
             self._parse_config(include_data, include_filename, fileconfig,
@@ -255,29 +283,76 @@ class PrinterConfig:
                 buffer.append(line)
         self._parse_config_buffer(buffer, filename, fileconfig)
         visited.remove(path)
-    def _build_config_wrapper(self, data, filename):
+    def _create_fileconfig(self):
         if sys.version_info.major >= 3:
-            fileconfig = configparser.RawConfigParser(
+            return configparser.RawConfigParser(
                 strict=False, inline_comment_prefixes=(';', '#'))
-        else:
-            fileconfig = configparser.RawConfigParser()
+        return configparser.RawConfigParser()
+    def _build_config_wrapper(self, data, filename):
+        fileconfig = self._create_fileconfig()
         self._parse_config(data, filename, fileconfig, set())
         return ConfigWrapper(self.printer, fileconfig, {}, 'printer')
+    def _restore_config_wrapper(self, snapshot):
+        fileconfig = self._create_fileconfig()
+        for section, options in snapshot:
+            fileconfig.add_section(section)
+            for option, value in options:
+                fileconfig.set(section, option, value)
+        return ConfigWrapper(self.printer, fileconfig, {}, 'printer')
+    # Parse cache handling
+    def _check_parse_deps(self, deps):
+        for dep_type, name, value in deps:
+            if dep_type == 'glob':
+                if tuple(sorted(glob.glob(name))) != value:
+                    return False
+                continue
+            try:
+                with open(name, 'r') as f:
+                    data = f.read()
+            except (IOError, OSError):
+                return False
+            if _get_data_hash(data.replace('\r\n', '\n')) != value:
+                return False
+        return True
+    def _cached_parse(self, key, parse_func):
+        # Returns the config wrappers created by parse_func(), restoring
+        # them from the parse cache if none of the input files changed
+        entry = parse_cache.get(key)
+        if entry is not None and self._check_parse_deps(entry[0]):
+            return [self._restore_config_wrapper(snapshot)
+                    for snapshot in entry[1]]
+        self.parse_deps = deps = []
+        try:
+            configs = parse_func()
+        finally:
+            self.parse_deps = None
+        # Files may be read more than once (eg, includes), only check once
+        deps = [dep for i, dep in enumerate(deps) if dep not in deps[:i]]
+        parse_cache[key] = (deps, [_snapshot_fileconfig(c.fileconfig)
+                                   for c in configs])
+        return configs
     def _build_config_string(self, config):
         sfile = io.StringIO()
         config.fileconfig.write(sfile)
         return sfile.getvalue().strip()
     def read_config(self, filename):
-        return self._build_config_wrapper(self._read_config_file(filename),
-                                          filename)
+        def parse():
+            data = self._read_config_file(filename)
+            return [self._build_config_wrapper(data, filename)]
+        return self._cached_parse(('config', filename), parse)[0]
     def read_main_config(self):
         filename = self.printer.get_start_args()['config_file']
-        data = self._read_config_file(filename)
-        regular_data, autosave_data = self._find_autosave_data(data)
-        regular_config = self._build_config_wrapper(regular_data, filename)
-        autosave_data = self._strip_duplicates(autosave_data, regular_config)
-        self.autosave = self._build_config_wrapper(autosave_data, filename)
-        cfg = self._build_config_wrapper(regular_data + autosave_data, filename)
+        def parse():
+            data = self._read_config_file(filename)
+            regular_data, autosave_data = self._find_autosave_data(data)
+            regular_config = self._build_config_wrapper(regular_data, filename)
+            autosave_data = self._strip_duplicates(autosave_data,
+                                                   regular_config)
+            autosave = self._build_config_wrapper(autosave_data, filename)
+            cfg = self._build_config_wrapper(regular_data + autosave_data,
+                                             filename)
+            return [autosave, cfg]
+        self.autosave, cfg = self._cached_parse(('main', filename), parse)
         return cfg
     def check_unused_options(self, config):
         fileconfig = config.fileconfig
@@ -329,6 +404,7 @@ class PrinterConfig:
             res['option'] = option
             self.status_warnings.append(res)
     def get_status(self, eventtime):
+        self._update_pending_status()
         return {'config': self.status_raw_config,
                 'settings': self.status_settings,
                 'warnings': self.status_warnings,
@@ -340,16 +416,36 @@ class PrinterConfig:
             self.autosave.fileconfig.add_section(section)
         svalue = str(value)
         self.autosave.fileconfig.set(section, option, svalue)
+        self.save_config_pending = True
+        # Rapid changes (eg, from a display slider) are only logged once
+        # the value stops changing, and only added to the status when it
+        # is next requested
+        self.pending_sets[(section, option)] = svalue
+        self.pending_status_sets[(section, option)] = svalue
+        reactor = self.printer.get_reactor()
+        reactor.update_timer(self.pending_sets_timer,
+                             reactor.monotonic() + SET_REPORT_DELAY)
+    def _update_pending_status(self):
+        if not self.pending_status_sets:
+            return
         pending = dict(self.status_save_pending)
-        if not section in pending or pending[section] is None:
-            pending[section] = {}
-        else:
-            pending[section] = dict(pending[section])
-        pending[section][option] = svalue
+        for (section, option), svalue in self.pending_status_sets.items():
+            if not section in pending or pending[section] is None:
+                pending[section] = {}
+            elif pending[section] is self.status_save_pending.get(section):
+                pending[section] = dict(pending[section])
+            pending[section][option] = svalue
         self.status_save_pending = pending
-        self.save_config_pending = True
-        logging.info("save_config: set [%s] %s = %s", section, option, svalue)
+        self.pending_status_sets.clear()
+    def _report_pending_sets(self, eventtime=None):
+        self._update_pending_status()
+        for (section, option), svalue in self.pending_sets.items():
+            logging.info("save_config: set [%s] %s = %s",
+                         section, option, svalue)
+        self.pending_sets.clear()
+        return self.printer.get_reactor().NEVER
     def remove_section(self, section):
+        self._report_pending_sets()
         if self.autosave.fileconfig.has_section(section):
             self.autosave.fileconfig.remove_section(section)
             pending = dict(self.status_save_pending)
@@ -372,6 +468,7 @@ class PrinterConfig:
                     raise gcode.error(msg)
     cmd_SAVE_CONFIG_help = "Overwrite config file and restart"
     def cmd_SAVE_CONFIG(self, gcmd):
+        self._report_pending_sets()
         if not self.autosave.fileconfig.sections():
             return
         gcode = self.printer.lookup_object('gcode')
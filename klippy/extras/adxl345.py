@@ -4,8 +4,14 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, time, collections, threading, multiprocessing, os
+import queue, struct, tempfile
 from . import bus, motion_report
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # ADXL345 registers
 REG_DEVID = 0x00
 REG_BW_RATE = 0x2C
@@ -30,6 +36,95 @@ SCALE_Z  = 0.003906 * FREEFALL_ACCEL # 1 / 256 (at 3.3V) mg/LSB
 Accel_Measurement = collections.namedtuple(
     'Accel_Measurement', ('time', 'accel_x', 'accel_y', 'accel_z'))
 
+# The .npy header is written with a fixed size so that it can be
+# rewritten with the final sample count once the capture completes
+NPY_HEADER_SIZE = 128
+# Maximum number of messages waiting to be written to a capture file
+CAPTURE_QUEUE_SIZE = 100
+
+def _build_npy_header(count):
+    header = "{'descr': '<f8', 'fortran_order': False, 'shape': (%d, 4), }" % (
+        count,)
+    header_len = NPY_HEADER_SIZE - 10
+    header = header.ljust(header_len - 1) + "\n"
+    return (b"\x93NUMPY\x01\x00" + struct.pack("<H", header_len)
+            + header.encode())
+
+# An internal webhooks client that streams decoded samples to a .npy
+# file from a background thread instead of holding them in memory
+class AccelCaptureClient:
+    def __init__(self, printer, capture_dir, name):
+        self.reactor = printer.get_reactor()
+        fd, self.filename = tempfile.mkstemp(
+            prefix="accel-%s-" % (name,), suffix=".npy", dir=capture_dir)
+        self.fileobj = os.fdopen(fd, 'wb')
+        self.fileobj.write(_build_npy_header(0))
+        self.queue = queue.Queue(CAPTURE_QUEUE_SIZE)
+        self.is_done = self.has_error = False
+        self.count = self.dropped = 0
+        self.samples = numpy.empty((0, 4))
+        self.writer = threading.Thread(target=self._write_samples)
+        self.writer.daemon = True
+        self.writer.start()
+    def _write_samples(self):
+        while 1:
+            try:
+                data = self.queue.get(timeout=.100)
+            except queue.Empty:
+                if self.is_done and self.queue.empty():
+                    break
+                continue
+            if self.has_error:
+                continue
+            try:
+                self.fileobj.write(data.tobytes())
+            except (IOError, OSError):
+                logging.exception("Error writing accelerometer capture %s",
+                                  self.filename)
+                self.has_error = True
+                continue
+            self.count += len(data)
+    def get_messages(self):
+        return []
+    def get_capture(self):
+        return self.samples
+    def finalize(self):
+        if self.is_done:
+            return
+        self.is_done = True
+        # Wait for the pending samples to be written without blocking
+        # the reactor
+        eventtime = self.reactor.monotonic()
+        while self.writer.is_alive():
+            eventtime = self.reactor.pause(eventtime + .100)
+        self.writer.join()
+        if self.dropped:
+            logging.error("Accelerometer capture %s: the disk could not keep"
+                          " up, %d messages dropped", self.filename,
+                          self.dropped)
+            self.has_error = True
+        try:
+            self.fileobj.seek(0)
+            self.fileobj.write(_build_npy_header(self.count))
+            self.fileobj.close()
+            if self.count and not self.has_error:
+                # The mapping remains valid after the file is unlinked
+                self.samples = numpy.load(self.filename, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            logging.exception("Error loading accelerometer capture %s",
+                              self.filename)
+        finally:
+            os.unlink(self.filename)
+    def is_closed(self):
+        return self.is_done
+    def send(self, msg):
+        data = numpy.ascontiguousarray(msg['params']['data'], dtype='<f8')
+        try:
+            self.queue.put_nowait(data.reshape(-1, 4))
+        except queue.Full:
+            # A capture with missing samples is discarded in finalize()
+            self.dropped += 1
+
 # Helper class to obtain measurements
 class AccelQueryHelper:
     def __init__(self, printer, cconn):
@@ -49,6 +144,8 @@ class AccelQueryHelper:
             self.raw_samples = raw_samples
         return self.raw_samples
     def has_valid_samples(self):
+        if isinstance(self.cconn, AccelCaptureClient):
+            return len(self.get_samples()) > 0
         raw_samples = self._get_raw_samples()
         for msg in raw_samples:
             data = msg['params']['data']
@@ -67,9 +164,27 @@ class AccelQueryHelper:
             return True
         return False
     def get_samples(self):
+        if isinstance(self.cconn, AccelCaptureClient):
+            # Select the requested time range of the memory-mapped capture
+            data = self.cconn.get_capture()
+            times = data[:,0]
+            start = numpy.searchsorted(times, self.request_start_time, 'left')
+            end = numpy.searchsorted(times, self.request_end_time, 'right')
+            self.samples = data[start:end]
+            return self.samples
         raw_samples = self._get_raw_samples()
         if not raw_samples:
             return self.samples
+        if numpy is not None and isinstance(raw_samples[0]['params']['data'],
+                                            numpy.ndarray):
+            # Samples were decoded into arrays - select them in one pass
+            data = numpy.concatenate([m['params']['data']
+                                      for m in raw_samples])
+            times = data[:,0]
+            valid = ((times >= self.request_start_time)
+                     & (times <= self.request_end_time))
+            self.samples = data[valid]
+            return self.samples
         total = sum([len(m['params']['data']) for m in raw_samples])
         count = 0
         self.samples = samples = [None] * total
@@ -84,6 +199,9 @@ class AccelQueryHelper:
         del samples[count:]
         return self.samples
     def write_to_file(self, filename):
+        if isinstance(self.cconn, AccelCaptureClient):
+            # Map the capture before the writing process is started
+            self.get_samples()
         def write_impl():
             try:
                 # Try to re-nice writing process
@@ -92,7 +210,13 @@ class AccelQueryHelper:
                 pass
             f = open(filename, "w")
             f.write("#time,accel_x,accel_y,accel_z\n")
-            samples = self.samples or self.get_samples()
+            samples = self.samples
+            if not len(samples):
+                samples = self.get_samples()
+            if numpy is not None and isinstance(samples, numpy.ndarray):
+                numpy.savetxt(f, samples, fmt="%.6f", delimiter=',')
+                f.close()
+                return
             for t, accel_x, accel_y, accel_z in samples:
                 f.write("%.6f,%.6f,%.6f,%.6f\n" % (
                     t, accel_x, accel_y, accel_z))
@@ -157,7 +281,7 @@ class AccelCommandHelper:
         self.printer.lookup_object('toolhead').dwell(1.)
         aclient.finish_measurements()
         values = aclient.get_samples()
-        if not values:
+        if not len(values):
             raise gcmd.error("No accelerometer measurements found")
         _, accel_x, accel_y, accel_z = values[-1]
         gcmd.respond_info("accelerometer values (x, y, z): %.6f, %.6f, %.6f"
@@ -255,7 +379,8 @@ class ADXL345:
         mcu.add_config_cmd("query_adxl345 oid=%d clock=0 rest_ticks=0"
                            % (oid,), on_restart=True)
         mcu.register_config_callback(self._build_config)
-        mcu.register_response(self._handle_adxl345_data, "adxl345_data", oid)
+        mcu.register_response(self._handle_adxl345_data, "adxl345_data", oid,
+                              as_tuple=True)
         # Clock tracking
         self.last_sequence = self.max_query_duration = 0
         self.last_limit_count = self.last_error_count = 0
@@ -296,9 +421,12 @@ class ADXL345:
     def is_measuring(self):
         return self.query_rate > 0
     def _handle_adxl345_data(self, params):
+        # params is a tuple of (oid, sequence, data, sent_time, receive_time)
         with self.lock:
             self.raw_samples.append(params)
     def _extract_samples(self, raw_samples):
+        if numpy is not None:
+            return self._extract_samples_numpy(raw_samples)
         # Load variables to optimize inner loop below
         (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
         last_sequence = self.last_sequence
@@ -307,10 +435,10 @@ class ADXL345:
         count = seq = 0
         samples = [None] * (len(raw_samples) * SAMPLES_PER_BLOCK)
         for params in raw_samples:
-            seq_diff = (last_sequence - params['sequence']) & 0xffff
+            seq_diff = (last_sequence - params[1]) & 0xffff
             seq_diff -= (seq_diff & 0x8000) << 1
             seq = last_sequence - seq_diff
-            d = bytearray(params['data'])
+            d = bytearray(params[2])
             msg_cdiff = seq * SAMPLES_PER_BLOCK - chip_base
             for i in range(len(d) // BYTES_PER_SAMPLE):
                 d_xyz = d[i*BYTES_PER_SAMPLE:(i+1)*BYTES_PER_SAMPLE]
@@ -332,6 +460,50 @@ class ADXL345:
         self.clock_sync.set_last_chip_clock(seq * SAMPLES_PER_BLOCK + i)
         del samples[count:]
         return samples
+    def _extract_samples_numpy(self, raw_samples):
+        # Decode all messages at once into an array of (time, x, y, z)
+        last_sequence = self.last_sequence
+        time_base, chip_base, inv_freq = self.clock_sync.get_time_translation()
+        datas = []
+        msg_cdiffs = []
+        counts = []
+        seq = count = 0
+        for params in raw_samples:
+            seq_diff = (last_sequence - params[1]) & 0xffff
+            seq_diff -= (seq_diff & 0x8000) << 1
+            seq = last_sequence - seq_diff
+            d = params[2]
+            count = len(d) // BYTES_PER_SAMPLE
+            datas.append(d[:count * BYTES_PER_SAMPLE])
+            msg_cdiffs.append(seq * SAMPLES_PER_BLOCK - chip_base)
+            counts.append(count)
+        self.clock_sync.set_last_chip_clock(seq * SAMPLES_PER_BLOCK + count - 1)
+        raw = numpy.frombuffer(b"".join(datas), dtype=numpy.uint8)
+        raw = raw.reshape(-1, BYTES_PER_SAMPLE).astype(numpy.int32)
+        # Chip clock offset of each sample
+        counts = numpy.array(counts)
+        starts = numpy.cumsum(counts) - counts
+        sample_cdiff = numpy.repeat(numpy.array(msg_cdiffs, dtype=float)
+                                    - starts, counts) + numpy.arange(len(raw))
+        # Discard samples flagged as invalid by the mcu
+        yzhigh = raw[:,4]
+        valid = (yzhigh & 0x80) == 0
+        num_valid = int(numpy.count_nonzero(valid))
+        self.last_error_count += len(raw) - num_valid
+        if num_valid != len(raw):
+            raw = raw[valid]
+            sample_cdiff = sample_cdiff[valid]
+        xlow, ylow, zlow, xzhigh, yzhigh = raw.T
+        raw_xyz = numpy.empty((len(raw), 3))
+        raw_xyz[:,0] = (xlow | ((xzhigh & 0x1f) << 8)) - ((xzhigh & 0x10) << 9)
+        raw_xyz[:,1] = (ylow | ((yzhigh & 0x1f) << 8)) - ((yzhigh & 0x10) << 9)
+        raw_xyz[:,2] = ((zlow | ((xzhigh & 0xe0) << 3) | ((yzhigh & 0xe0) << 6))
+                        - ((yzhigh & 0x40) << 7))
+        samples = numpy.empty((len(raw), 4))
+        samples[:,0] = time_base + sample_cdiff * inv_freq
+        for i, (pos, scale) in enumerate(self.axes_map):
+            samples[:,i+1] = raw_xyz[:,pos] * scale
+        return numpy.round(samples, 6, out=samples)
     def _update_clock(self, minclock=0):
         # Query current state
         for retry in range(5):
@@ -421,7 +593,7 @@ class ADXL345:
         if not raw_samples:
             return {}
         samples = self._extract_samples(raw_samples)
-        if not samples:
+        if not len(samples):
             return {}
         return {'data': samples, 'errors': self.last_error_count,
                 'overflows': self.last_limit_count}
@@ -434,8 +606,8 @@ class ADXL345:
         self.api_dump.add_client(web_request)
         hdr = ('time', 'x_acceleration', 'y_acceleration', 'z_acceleration')
         web_request.send({'header': hdr})
-    def start_internal_client(self):
-        cconn = self.api_dump.add_internal_client()
+    def start_internal_client(self, cconn=None):
+        cconn = self.api_dump.add_internal_client(cconn)
         return AccelQueryHelper(self.printer, cconn)
 
 def load_config(config):
@@ -0,0 +1,218 @@
+# Pre-parsed g-code file cache for virtual_sdcard
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, sys, io, struct, marshal, logging, multiprocessing, hashlib
+
+# The cache file is a header followed by a series of independent blocks.
+# Each block holds the marshal encoded parse results of consecutive
+# lines of the source file.  Each line is stored as a tuple of (length,
+# cmd, origline, params), or just (length,) for lines without a
+# command.  Line lengths include the trailing newline so that the
+# original file positions can be tracked.
+CACHE_MAGIC = b"KGCC"
+CACHE_VERSION = 1
+HEADER = struct.Struct("<4sHHHQQ")
+BLOCK_HEADER = struct.Struct("<QII")
+LINES_PER_BLOCK = 1024
+READ_SIZE = 65536
+
+# Cache files are named by a hash of the path relative to the sdcard
+# directory (so that different paths can not map to the same cache)
+def get_cache_filename(cache_dir, filename):
+    path = filename.strip('/')
+    path_hash = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, "%s-%s.kgc" % (
+        os.path.basename(path), path_hash[:16]))
+
+def _build_header(src_filename):
+    st = os.stat(src_filename)
+    return HEADER.pack(CACHE_MAGIC, CACHE_VERSION, marshal.version,
+                       sys.version_info[0] * 100 + sys.version_info[1],
+                       st.st_size, st.st_mtime_ns)
+
+def _write_cache(parse_line, src_filename, out_filename):
+    header = _build_header(src_filename)
+    with io.open(src_filename, 'r', newline='') as src, \
+         open(out_filename, 'wb') as out:
+        out.write(header)
+        partial_input = ""
+        block = []
+        block_pos = pos = 0
+        while 1:
+            data = src.read(READ_SIZE)
+            if not data:
+                break
+            lines = data.split('\n')
+            lines[0] = partial_input + lines[0]
+            partial_input = lines.pop()
+            for line in lines:
+                linelen = len(line) + 1
+                cmd, origline, params = parse_line(line)
+                if cmd:
+                    block.append((linelen, cmd, origline, params))
+                else:
+                    block.append((linelen,))
+                pos += linelen
+                if len(block) >= LINES_PER_BLOCK:
+                    payload = marshal.dumps(block)
+                    out.write(BLOCK_HEADER.pack(block_pos, len(block),
+                                                len(payload)))
+                    out.write(payload)
+                    block = []
+                    block_pos = pos
+        if block:
+            payload = marshal.dumps(block)
+            out.write(BLOCK_HEADER.pack(block_pos, len(block), len(payload)))
+            out.write(payload)
+
+# Generate a cache file from a g-code file
+def compile_file(parse_line, src_filename, cache_filename):
+    tmp_filename = cache_filename + ".tmp"
+    try:
+        _write_cache(parse_line, src_filename, tmp_filename)
+        os.rename(tmp_filename, cache_filename)
+    except:
+        # Don't leave a partial cache file behind
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+# Stream the parsed lines of a cache file
+class CacheReader:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.skip_lines = 0
+    def seek(self, file_position):
+        # Position the reader at a source file position.  Returns False
+        # if the position is not at the start of a line.
+        f = self.fileobj
+        f.seek(HEADER.size)
+        found = None
+        while 1:
+            offset = f.tell()
+            data = f.read(BLOCK_HEADER.size)
+            if len(data) < BLOCK_HEADER.size:
+                break
+            block_pos, count, size = BLOCK_HEADER.unpack(data)
+            if block_pos > file_position:
+                break
+            found = (offset, block_pos, size)
+            f.seek(size, os.SEEK_CUR)
+        if found is None:
+            return not file_position
+        offset, pos, size = found
+        f.seek(offset + BLOCK_HEADER.size)
+        block = marshal.loads(f.read(size))
+        skip_lines = 0
+        for line in block:
+            if pos >= file_position:
+                break
+            pos += line[0]
+            skip_lines += 1
+        if pos != file_position:
+            return False
+        f.seek(offset)
+        self.skip_lines = skip_lines
+        return True
+    def read_batch(self):
+        # Returns a list of parsed lines (in reverse order) or None on
+        # end of file.
+        data = self.fileobj.read(BLOCK_HEADER.size)
+        if len(data) < BLOCK_HEADER.size:
+            return None
+        block_pos, count, size = BLOCK_HEADER.unpack(data)
+        block = marshal.loads(self.fileobj.read(size))
+        if self.skip_lines:
+            del block[:self.skip_lines]
+            self.skip_lines = 0
+        block.reverse()
+        return block
+    def close(self):
+        self.fileobj.close()
+
+# Cache management for virtual_sdcard
+class GCodeCache:
+    def __init__(self, config, sdcard_dirname):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        cache_dir = config.get('gcode_cache_path', None)
+        if cache_dir is None:
+            cache_dir = os.path.join(sdcard_dirname, ".gcode_cache")
+        self.cache_dir = os.path.normpath(os.path.expanduser(cache_dir))
+        self.compile_procs = {}
+    def _is_valid(self, src_filename, cache_filename):
+        try:
+            with open(cache_filename, 'rb') as f:
+                header = f.read(HEADER.size)
+            return header == _build_header(src_filename)
+        except (IOError, OSError):
+            return False
+    def open_reader(self, src_filename, filename, file_position):
+        # Returns a CacheReader for the given file, or None if no valid
+        # cache is available
+        cache_filename = get_cache_filename(self.cache_dir, filename)
+        proc = self.compile_procs.get(filename)
+        if proc is not None and proc.is_alive():
+            return None
+        if not self._is_valid(src_filename, cache_filename):
+            return None
+        try:
+            reader = CacheReader(open(cache_filename, 'rb'))
+        except (IOError, OSError):
+            logging.exception("gcode_cache open")
+            return None
+        if not reader.seek(file_position):
+            logging.info("gcode_cache: position %d not found in %s",
+                         file_position, cache_filename)
+            reader.close()
+            return None
+        return reader
+    def _compile_proc(self, parse_line, src_filename, cache_filename):
+        import queuelogger
+        queuelogger.clear_bg_logging()
+        try:
+            compile_file(parse_line, src_filename, cache_filename)
+        except:
+            logging.exception("gcode_cache compile")
+            sys.exit(1)
+    def start_compile(self, src_filename, filename):
+        # Start generating a cache in a background process (if needed).
+        # Returns None if no compile was started.
+        cache_filename = get_cache_filename(self.cache_dir, filename)
+        proc = self.compile_procs.get(filename)
+        if proc is not None:
+            if proc.is_alive():
+                return proc
+            proc.join()
+            del self.compile_procs[filename]
+        if self._is_valid(src_filename, cache_filename):
+            return None
+        parse_line = self.printer.lookup_object('gcode').parse_line
+        logging.info("gcode_cache: compiling %s", filename)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            proc = multiprocessing.Process(
+                target=self._compile_proc,
+                args=(parse_line, src_filename, cache_filename))
+            proc.daemon = True
+            proc.start()
+        except (IOError, OSError):
+            # The file is still read directly from the sdcard
+            logging.exception("gcode_cache: unable to compile %s", filename)
+            return None
+        self.compile_procs[filename] = proc
+        return proc
+    def compile(self, src_filename, filename):
+        # Generate a cache and wait for it to complete
+        proc = self.start_compile(src_filename, filename)
+        if proc is None:
+            cache_filename = get_cache_filename(self.cache_dir, filename)
+            return self._is_valid(src_filename, cache_filename)
+        eventtime = self.reactor.monotonic()
+        while proc.is_alive():
+            eventtime = self.reactor.pause(eventtime + .1)
+        proc.join()
+        del self.compile_procs[filename]
+        return proc.exitcode == 0
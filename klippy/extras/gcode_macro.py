@@ -3,7 +3,7 @@
 # Copyright (C) 2018-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import traceback, logging, ast, copy
+import traceback, logging, ast, copy, time, os, hashlib
 import jinja2
 
 
@@ -39,22 +39,46 @@ class GetStatusWrapper:
             if self.__contains__(name):
                 yield name
 
-# Wrapper around a Jinja2 template
+# Wrapper around a Jinja2 template.  If lazy is set, the template is
+# only checked for syntax errors at load time and is not compiled until
+# it is first rendered.
 class TemplateWrapper:
-    def __init__(self, printer, env, name, script):
+    def __init__(self, printer, env, name, script, lazy=False):
         self.printer = printer
         self.name = name
         self.gcode = self.printer.lookup_object('gcode')
         gcode_macro = self.printer.lookup_object('gcode_macro')
         self.create_template_context = gcode_macro.create_template_context
+        self.compile_template = gcode_macro.compile_template
+        self.env = env
+        self.script = script
+        self.template = None
+        if lazy:
+            self._check_syntax()
+        else:
+            self._compile(printer.config_error)
+    def _check_syntax(self):
+        try:
+            self.env.parse(self.script)
+        except Exception as e:
+            msg = "Error loading template '%s': %s" % (
+                 self.name, traceback.format_exception_only(type(e), e)[-1])
+            logging.exception(msg)
+            raise self.printer.config_error(msg)
+    def _compile(self, error):
+        start_time = time.perf_counter()
         try:
-            self.template = env.from_string(script)
+            self.template = self.compile_template(self.env, self.script)
         except Exception as e:
             msg = "Error loading template '%s': %s" % (
-                 name, traceback.format_exception_only(type(e), e)[-1])
+                 self.name, traceback.format_exception_only(type(e), e)[-1])
             logging.exception(msg)
-            raise printer.config_error(msg)
+            raise error(msg)
+        self.printer.get_startup_profiler().note(
+            'template', self.name, time.perf_counter() - start_time)
     def render(self, context=None):
+        if self.template is None:
+            self._compile(self.gcode.error)
         if context is None:
             context = self.create_template_context()
         try:
@@ -67,11 +91,95 @@ class TemplateWrapper:
     def run_gcode_from_command(self, context=None):
         self.gcode.run_script_from_command(self.render(context))
 
+# File backed cache of compiled templates.  Templates are stored by a
+# hash of their source and the environment settings used to compile them.
+class TemplateBytecodeCache(jinja2.BytecodeCache):
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = self.misses = self.errors = 0
+    def _get_filename(self, bucket):
+        return os.path.join(self.directory, bucket.key + ".jbc")
+    def load_bytecode(self, bucket):
+        try:
+            with open(self._get_filename(bucket), 'rb') as f:
+                bucket.load_bytecode(f)
+        except (IOError, OSError):
+            pass
+        except Exception:
+            logging.exception("Unable to load template cache")
+            bucket.reset()
+            self.errors += 1
+    def dump_bytecode(self, bucket):
+        filename = self._get_filename(bucket)
+        tmp_filename = filename + ".tmp"
+        try:
+            with open(tmp_filename, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            logging.exception("Unable to store template cache")
+            self.errors += 1
+    def _get_env_signature(self, env):
+        # Callable settings are identified by name (their repr includes
+        # an address that changes between runs)
+        def ident(obj):
+            if not callable(obj):
+                return obj
+            return "%s.%s" % (getattr(obj, '__module__', None),
+                              getattr(obj, '__qualname__',
+                                      type(obj).__qualname__))
+        return repr((getattr(jinja2, '__version__', None),
+                     env.block_start_string, env.block_end_string,
+                     env.variable_start_string, env.variable_end_string,
+                     env.comment_start_string, env.comment_end_string,
+                     env.line_statement_prefix, env.line_comment_prefix,
+                     env.trim_blocks, env.lstrip_blocks,
+                     env.newline_sequence, env.keep_trailing_newline,
+                     ident(env.autoescape), ident(env.finalize),
+                     env.optimized, ident(env.undefined),
+                     getattr(env, 'is_async', False),
+                     sorted(env.extensions.keys()), sorted(env.filters.keys()),
+                     sorted(env.tests.keys())))
+    def compile_template(self, env, source):
+        sig = self._get_env_signature(env) + "\n" + source
+        name = hashlib.sha1(sig.encode('utf-8')).hexdigest()
+        bucket = self.get_bucket(env, name, None, source)
+        if bucket.code is None:
+            self.misses += 1
+            bucket.code = env.compile(source)
+            self.set_bucket(bucket)
+        else:
+            self.hits += 1
+        return env.template_class.from_code(env, bucket.code,
+                                            env.make_globals(None), None)
+    def get_stats(self):
+        return "hits=%d misses=%d errors=%d" % (
+            self.hits, self.misses, self.errors)
+
 # Main gcode macro template tracking
 class PrinterGCodeMacro:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.env = jinja2.Environment('{%', '%}', '{', '}')
+        self.bytecode_cache = None
+        cache_dir = config.get('template_cache_path', None)
+        if cache_dir is not None:
+            cache_dir = os.path.normpath(os.path.expanduser(cache_dir))
+            try:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                self.bytecode_cache = TemplateBytecodeCache(cache_dir)
+                self.printer.register_event_handler("klippy:ready",
+                                                    self._handle_ready)
+            except OSError:
+                logging.exception("Unable to create template cache directory")
+    def _handle_ready(self):
+        logging.info("gcode_macro: template cache %s",
+                     self.bytecode_cache.get_stats())
+    def compile_template(self, env, script):
+        if self.bytecode_cache is None:
+            return env.from_string(script)
+        return self.bytecode_cache.compile_template(env, script)
     def load_template(self, config, option, default=None):
         name = "%s:%s" % (config.get_name(), option)
         if default is None:
@@ -3,7 +3,7 @@
 # Copyright (C) 2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
+import logging, struct, sys, zlib, base64, array
 import chelper
 
 API_UPDATE_INTERVAL = 0.500
@@ -11,9 +11,11 @@ API_UPDATE_INTERVAL = 0.500
 # Helper to periodically transmit data to a set of API clients
 class APIDumpHelper:
     def __init__(self, printer, data_cb, startstop_cb=None,
-                 update_interval=API_UPDATE_INTERVAL):
+                 update_interval=API_UPDATE_INTERVAL, encoders=None):
         self.printer = printer
         self.data_cb = data_cb
+        # Optional alternate message encodings: {name: encode_func}
+        self.encoders = encoders or {}
         if startstop_cb is None:
             startstop_cb = (lambda is_start: None)
         self.startstop_cb = startstop_cb
@@ -56,12 +58,20 @@ class APIDumpHelper:
     def add_client(self, web_request):
         cconn = web_request.get_client_connection()
         template = web_request.get_dict('response_template', {})
-        self.clients[cconn] = template
-        self._start()
-    def add_internal_client(self):
-        cconn = InternalDumpClient()
-        self.clients[cconn] = {}
+        encoding = web_request.get_str('encoding', 'json')
+        if encoding != 'json' and encoding not in self.encoders:
+            raise web_request.error("Unsupported encoding '%s'" % (encoding,))
+        self.clients[cconn] = (template, encoding)
         self._start()
+    def add_internal_client(self, cconn=None):
+        if cconn is None:
+            cconn = InternalDumpClient()
+        self.clients[cconn] = ({}, 'json')
+        try:
+            self._start()
+        except:
+            cconn.finalize()
+            raise
         return cconn
     def _update(self, eventtime):
         try:
@@ -71,14 +81,19 @@ class APIDumpHelper:
             return self._stop()
         if not msg:
             return eventtime + self.update_interval
-        for cconn, template in list(self.clients.items()):
+        encoded = {'json': msg}
+        for cconn, (template, encoding) in list(self.clients.items()):
             if cconn.is_closed():
                 del self.clients[cconn]
                 if not self.clients:
                     return self._stop()
                 continue
+            emsg = encoded.get(encoding)
+            if emsg is None:
+                # Each encoding is only generated once per update
+                emsg = encoded[encoding] = self.encoders[encoding](msg)
             tmp = dict(template)
-            tmp['params'] = msg
+            tmp['params'] = emsg
             cconn.send(tmp)
         return eventtime + self.update_interval
 
@@ -99,13 +114,65 @@ class InternalDumpClient:
             # Avoid filling up memory with too many samples
             self.finalize()
 
+# Packed "binary" encoding of the "data" field of dump messages.  The
+# values are copied column by column straight from the C structures
+# returned by chelper, zlib compressed (at the fastest level), and
+# transmitted as a base64 string in a "bdata" field.
+def _encode_bdata(msg, packed):
+    emsg = dict(msg)
+    del emsg['data']
+    emsg['bdata'] = base64.b64encode(zlib.compress(packed, 1)).decode()
+    return emsg
+
+# Pack the given struct fields of a list of (cdata, count) chunks (as
+# returned by chelper extraction functions, newest entry first within
+# each chunk) in chronological order, skipping the oldest 'skip' entries
+def _pack_columns(cdata, ctype, fmt, fields, skip=0):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    itemsize = struct.calcsize(fmt)
+    stride = ffi_main.sizeof(ctype) // itemsize
+    views = []
+    for data, count in cdata:
+        count -= skip
+        skip = 0
+        if count > 0:
+            views.append((memoryview(ffi_main.buffer(data)).cast(fmt), count))
+    out = []
+    for field in fields:
+        offset = ffi_main.offsetof(ctype, field) // itemsize
+        for mv, count in views:
+            out.append(mv[offset + (count - 1) * stride::-stride].tobytes())
+    packed = b"".join(out)
+    if sys.byteorder != 'little':
+        packed = array.array(fmt, packed)
+        packed.byteswap()
+        packed = packed.tobytes()
+    return packed
+
+# Stepper queue_step data - three 32-bit integers per queue_step
+def encode_stepper_binary(msg, cdata):
+    packed = _pack_columns(cdata, 'struct pull_history_steps', 'i',
+                           ('interval', 'step_count', 'add'))
+    return _encode_bdata(msg, packed)
+
+# Trapq moves - ten doubles per move
+def encode_trapq_binary(msg, cdata, skip=0):
+    packed = _pack_columns(cdata, 'struct pull_move', 'd',
+                           ('print_time', 'move_t', 'start_v', 'accel',
+                            'start_x', 'start_y', 'start_z',
+                            'x_r', 'y_r', 'z_r'), skip)
+    return _encode_bdata(msg, packed)
+
 # Extract stepper queue_step messages
 class DumpStepper:
     def __init__(self, printer, mcu_stepper):
         self.printer = printer
         self.mcu_stepper = mcu_stepper
         self.last_api_clock = 0
-        self.api_dump = APIDumpHelper(printer, self._api_update)
+        self.last_api_cdata = []
+        self.api_dump = APIDumpHelper(
+            printer, self._api_update,
+            encoders={'binary': self._api_encode_binary})
         wh = self.printer.lookup_object('webhooks')
         wh.register_mux_endpoint("motion_report/dump_stepper", "name",
                                  mcu_stepper.get_name(), self._add_api_client)
@@ -136,6 +203,7 @@ class DumpStepper:
         logging.info('\n'.join(out))
     def _api_update(self, eventtime):
         data, cdata = self.get_step_queue(self.last_api_clock, 1<<63)
+        self.last_api_cdata = cdata
         if not data:
             return {}
         clock_to_print_time = self.mcu_stepper.get_mcu().clock_to_print_time
@@ -154,6 +222,8 @@ class DumpStepper:
                 "start_mcu_position": mcu_pos, "step_distance": step_dist,
                 "first_clock": first_clock, "first_step_time": first_time,
                 "last_clock": last_clock, "last_step_time": last_time}
+    def _api_encode_binary(self, msg):
+        return encode_stepper_binary(msg, self.last_api_cdata)
     def _add_api_client(self, web_request):
         self.api_dump.add_client(web_request)
         hdr = ('interval', 'count', 'add')
@@ -168,7 +238,11 @@ class DumpTrapQ:
         self.name = name
         self.trapq = trapq
         self.last_api_msg = (0., 0.)
-        self.api_dump = APIDumpHelper(printer, self._api_update)
+        self.last_api_cdata = []
+        self.last_api_skip = 0
+        self.api_dump = APIDumpHelper(
+            printer, self._api_update,
+            encoders={'binary': self._api_encode_binary})
         wh = self.printer.lookup_object('webhooks')
         wh.register_mux_endpoint("motion_report/dump_trapq", "name", name,
                                  self._add_api_client)
@@ -216,12 +290,18 @@ class DumpTrapQ:
         d = [(m.print_time, m.move_t, m.start_v, m.accel,
               (m.start_x, m.start_y, m.start_z), (m.x_r, m.y_r, m.z_r))
              for m in data]
+        self.last_api_cdata = cdata
+        self.last_api_skip = 0
         if d and d[0] == self.last_api_msg:
             d.pop(0)
+            self.last_api_skip = 1
         if not d:
             return {}
         self.last_api_msg = d[-1]
         return {"data": d}
+    def _api_encode_binary(self, msg):
+        return encode_trapq_binary(msg, self.last_api_cdata,
+                                   self.last_api_skip)
     def _add_api_client(self, web_request):
         self.api_dump.add_client(web_request)
         hdr = ('time', 'duration', 'start_velocity', 'acceleration',
@@ -0,0 +1,124 @@
+# Per-stage timing of the host move processing pipeline
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import logging, time
+
+NUM_BUCKETS = 16
+
+# Timing histogram for a single pipeline stage.  Durations are binned
+# into power-of-two microsecond buckets (<1us, <2us, <4us, ...).
+class StageTimer:
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+    def reset(self):
+        self.count = 0
+        self.total_time = self.max_time = 0.
+        self.buckets = [0] * NUM_BUCKETS
+        self.reset_interval()
+    def reset_interval(self):
+        self.interval_count = 0
+        self.interval_time = self.interval_max = 0.
+    def note(self, duration):
+        self.count += 1
+        self.total_time += duration
+        if duration > self.max_time:
+            self.max_time = duration
+        self.interval_count += 1
+        self.interval_time += duration
+        if duration > self.interval_max:
+            self.interval_max = duration
+        bucket = min(int(duration * 1000000.).bit_length(), NUM_BUCKETS - 1)
+        self.buckets[bucket] += 1
+    def wrap(self, func):
+        perf_counter = time.perf_counter
+        note = self.note
+        def timed_func(*args, **kwargs):
+            start_time = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                note(perf_counter() - start_time)
+        return timed_func
+    def get_status(self):
+        avg = 0.
+        if self.count:
+            avg = self.total_time / self.count
+        return {'count': self.count, 'total_time': self.total_time,
+                'avg_time': avg, 'max_time': self.max_time,
+                'histogram_us': [[1 << i, c]
+                                 for i, c in enumerate(self.buckets) if c]}
+    def get_interval_stats(self):
+        count = self.interval_count
+        if not count:
+            return ""
+        avg = self.interval_time / count
+        msg = "%s_n=%d %s_avg=%.1f %s_max=%.1f" % (
+            self.name, count, self.name, avg * 1000000.,
+            self.name, self.interval_max * 1000000.)
+        self.reset_interval()
+        return msg
+
+class MoveProfiler:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.stage_names = ['gcode_parse', 'gcode_move', 'toolhead_move',
+                            'lookahead_flush', 'trapq_append', 'itersolve',
+                            'stepcompress']
+        self.stages = {name: StageTimer(name) for name in self.stage_names}
+        self.printer.register_event_handler("klippy:connect",
+                                            self._handle_connect)
+        # Register commands
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("move_profiler/dump_stats",
+                                   self._handle_dump_stats)
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command("MOVE_PROFILER_RESET",
+                               self.cmd_MOVE_PROFILER_RESET,
+                               desc=self.cmd_MOVE_PROFILER_RESET_help)
+    def _handle_connect(self):
+        # Wrap the entry points of each pipeline stage
+        stages = self.stages
+        gcode = self.printer.lookup_object('gcode')
+        gcode.parse_line = stages['gcode_parse'].wrap(gcode.parse_line)
+        for cmd in ['G0', 'G1']:
+            handler = gcode.ready_gcode_handlers.get(cmd)
+            if handler is not None:
+                gcode.ready_gcode_handlers[cmd] = stages['gcode_move'].wrap(
+                    handler)
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.move = stages['toolhead_move'].wrap(toolhead.move)
+        move_queue = toolhead.move_queue
+        move_queue.flush = stages['lookahead_flush'].wrap(move_queue.flush)
+        trapq_objs = [toolhead] + [
+            obj for name, obj in self.printer.lookup_objects()
+            if name.startswith('extruder') and hasattr(obj, 'trapq_append')]
+        for obj in trapq_objs:
+            obj.trapq_append = stages['trapq_append'].wrap(obj.trapq_append)
+        sgs = toolhead.step_generators
+        sgs[:] = [stages['itersolve'].wrap(sg) for sg in sgs]
+        for m in toolhead.all_mcus:
+            m.flush_moves = stages['stepcompress'].wrap(m.flush_moves)
+        logging.info("move_profiler: instrumented %s",
+                     " ".join(self.stage_names))
+    def _handle_dump_stats(self, web_request):
+        web_request.send({name: self.stages[name].get_status()
+                          for name in self.stage_names})
+        if web_request.get('reset', False):
+            self.reset()
+    def reset(self):
+        for stage in self.stages.values():
+            stage.reset()
+    cmd_MOVE_PROFILER_RESET_help = "Clear the move pipeline timing statistics"
+    def cmd_MOVE_PROFILER_RESET(self, gcmd):
+        self.reset()
+    def stats(self, eventtime):
+        msgs = [self.stages[name].get_interval_stats()
+                for name in self.stage_names]
+        msgs = [m for m in msgs if m]
+        if not msgs:
+            return False, ""
+        return False, "move_profiler: " + " ".join(msgs)
+
+def load_config(config):
+    return MoveProfiler(config)
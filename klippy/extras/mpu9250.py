@@ -267,8 +267,8 @@ class MPU9250:
         self.api_dump.add_client(web_request)
         hdr = ('time', 'x_acceleration', 'y_acceleration', 'z_acceleration')
         web_request.send({'header': hdr})
-    def start_internal_client(self):
-        cconn = self.api_dump.add_internal_client()
+    def start_internal_client(self, cconn=None):
+        cconn = self.api_dump.add_internal_client(cconn)
         return adxl345.AccelQueryHelper(self.printer, cconn)
 
 def load_config(config):
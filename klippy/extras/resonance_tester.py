@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math, os, time
-from . import shaper_calibrate
+from . import adxl345, shaper_calibrate
 
 class TestAxis:
     def __init__(self, axis=None, vib_dir=None):
@@ -129,6 +129,13 @@ class ResonanceTester:
             if self.accel_chip_names[0][1] == self.accel_chip_names[1][1]:
                 self.accel_chip_names = [('xy', self.accel_chip_names[0][1])]
         self.max_smoothing = config.getfloat('max_smoothing', None, minval=0.05)
+        self.capture_path = config.get('capture_path', None)
+        if self.capture_path is not None:
+            self.capture_path = os.path.normpath(
+                os.path.expanduser(self.capture_path))
+            if not os.path.isdir(self.capture_path):
+                raise config.error("capture_path '%s' is not a directory"
+                                   % (self.capture_path,))
 
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode.register_command("MEASURE_AXES_NOISE",
@@ -147,6 +154,23 @@ class ResonanceTester:
                 (chip_axis, self.printer.lookup_object(chip_name))
                 for chip_axis, chip_name in self.accel_chip_names]
 
+    def _start_client(self, chip, helper, raw_name_suffix):
+        if helper is not None and raw_name_suffix is None:
+            # Calculate the frequency response while the test is running
+            fclient = helper.start_freq_response()
+            try:
+                aclient = chip.start_internal_client(fclient)
+            except:
+                fclient.close()
+                raise
+            fclient.set_start_time(aclient.request_start_time)
+            return aclient, fclient
+        cconn = None
+        if self.capture_path is not None and adxl345.numpy is not None:
+            cconn = adxl345.AccelCaptureClient(
+                    self.printer, self.capture_path, chip.name)
+        return chip.start_internal_client(cconn), None
+
     def _run_test(self, gcmd, axes, helper, raw_name_suffix=None,
                   accel_chips=None, test_point=None):
         toolhead = self.printer.lookup_object('toolhead')
@@ -171,42 +195,63 @@ class ResonanceTester:
                     gcmd.respond_info("Testing axis %s" % axis.get_name())
 
                 raw_values = []
-                if accel_chips is None:
-                    for chip_axis, chip in self.accel_chips:
-                        if axis.matches(chip_axis):
-                            aclient = chip.start_internal_client()
-                            raw_values.append((chip_axis, aclient, chip.name))
-                else:
-                    for chip in accel_chips:
-                        aclient = chip.start_internal_client()
-                        raw_values.append((axis, aclient, chip.name))
-
-                # Generate moves
-                self.test.run_test(axis, gcmd)
-                for chip_axis, aclient, chip_name in raw_values:
-                    aclient.finish_measurements()
-                    if raw_name_suffix is not None:
-                        raw_name = self.get_filename(
-                                'raw_data', raw_name_suffix, axis,
-                                point if len(test_points) > 1 else None,
-                                chip_name if accel_chips is not None else None,)
-                        aclient.write_to_file(raw_name)
-                        gcmd.respond_info(
-                                "Writing raw accelerometer data to "
-                                "%s file" % (raw_name,))
-                if helper is None:
-                    continue
-                for chip_axis, aclient, chip_name in raw_values:
-                    if not aclient.has_valid_samples():
-                        raise gcmd.error(
-                            "accelerometer '%s' measured no data" % (
-                                chip_name,))
-                    new_data = helper.process_accelerometer_data(aclient)
-                    if calibration_data[axis] is None:
-                        calibration_data[axis] = new_data
-                    else:
-                        calibration_data[axis].add_data(new_data)
+                try:
+                    self._measure_axis(gcmd, axis, point, len(test_points),
+                                       helper, raw_name_suffix, accel_chips,
+                                       raw_values, calibration_data)
+                finally:
+                    # Release the clients even if the test was aborted
+                    for chip_axis, aclient, fclient, chip_name in raw_values:
+                        aclient.cconn.finalize()
+                        if fclient is not None:
+                            fclient.close()
         return calibration_data
+
+    def _measure_axis(self, gcmd, axis, point, num_points, helper,
+                      raw_name_suffix, accel_chips, raw_values,
+                      calibration_data):
+        if accel_chips is None:
+            for chip_axis, chip in self.accel_chips:
+                if axis.matches(chip_axis):
+                    aclient, fclient = self._start_client(
+                            chip, helper, raw_name_suffix)
+                    raw_values.append((chip_axis, aclient, fclient, chip.name))
+        else:
+            for chip in accel_chips:
+                aclient, fclient = self._start_client(
+                        chip, helper, raw_name_suffix)
+                raw_values.append((axis, aclient, fclient, chip.name))
+
+        # Generate moves
+        self.test.run_test(axis, gcmd)
+        for chip_axis, aclient, fclient, chip_name in raw_values:
+            aclient.finish_measurements()
+            if raw_name_suffix is not None:
+                raw_name = self.get_filename(
+                        'raw_data', raw_name_suffix, axis,
+                        point if num_points > 1 else None,
+                        chip_name if accel_chips is not None else None,)
+                aclient.write_to_file(raw_name)
+                gcmd.respond_info(
+                        "Writing raw accelerometer data to "
+                        "%s file" % (raw_name,))
+        if helper is None:
+            return
+        for chip_axis, aclient, fclient, chip_name in raw_values:
+            if fclient is not None:
+                new_data = fclient.get_calibration_data(
+                        aclient.request_end_time)
+            elif aclient.has_valid_samples():
+                new_data = helper.process_accelerometer_data(aclient)
+            else:
+                new_data = None
+            if new_data is None:
+                raise gcmd.error(
+                    "accelerometer '%s' measured no data" % (chip_name,))
+            if calibration_data[axis] is None:
+                calibration_data[axis] = new_data
+            else:
+                calibration_data[axis].add_data(new_data)
     cmd_TEST_RESONANCES_help = ("Runs the resonance test for a specifed axis")
     def cmd_TEST_RESONANCES(self, gcmd):
         # Parse parameters
@@ -4,20 +4,33 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging, ast, configparser
+import os, logging, ast, configparser, io, threading
+
+WRITE_RETRY_TIME = 5.
 
 class SaveVariables:
     def __init__(self, config):
         self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
         self.filename = os.path.expanduser(config.get('filename'))
+        self.save_delay = config.getfloat('save_delay', 1., minval=0.)
         self.allVariables = {}
+        # Delayed writes
+        self.is_dirty = False
+        self.write_thread = None
+        self.write_error = self.reported_error = None
+        self.write_timer = self.reactor.register_timer(self._write_event)
+        self.printer.register_event_handler("klippy:shutdown",
+                                            self._handle_shutdown)
+        self.printer.register_event_handler("klippy:disconnect",
+                                            self._handle_disconnect)
         try:
             if not os.path.exists(self.filename):
                 open(self.filename, "w").close()
             self.loadVariables()
         except self.printer.command_error as e:
             raise config.error(str(e))
-        gcode = self.printer.lookup_object('gcode')
+        self.gcode = gcode = self.printer.lookup_object('gcode')
         gcode.register_command('SAVE_VARIABLE', self.cmd_SAVE_VARIABLE,
                                desc=self.cmd_SAVE_VARIABLE_help)
     def loadVariables(self):
@@ -33,6 +46,76 @@ class SaveVariables:
             logging.exception(msg)
             raise self.printer.command_error(msg)
         self.allVariables = allvars
+    def _build_file_data(self):
+        varfile = configparser.ConfigParser()
+        varfile.add_section('Variables')
+        for name, val in sorted(self.allVariables.items()):
+            varfile.set('Variables', name, repr(val))
+        sfile = io.StringIO()
+        varfile.write(sfile)
+        return sfile.getvalue()
+    def _write_file(self, data):
+        # Write to a temporary file and rename it over the variables
+        # file, so that the file is never left partially written
+        temp_name = self.filename + ".tmp"
+        with open(temp_name, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_name, self.filename)
+    def _write_thread(self, data):
+        try:
+            self._write_file(data)
+        except Exception as e:
+            logging.exception("Unable to save variables")
+            self.write_error = "Unable to save variables: %s" % (str(e),)
+            return
+        self.write_error = None
+    def _check_write_thread(self):
+        # Note the result of a completed background write
+        self.write_thread.join()
+        self.write_thread = None
+        if self.write_error is not None:
+            # Keep the changes pending until they are written
+            self.is_dirty = True
+            return False
+        return True
+    def _write_event(self, eventtime):
+        if self.write_thread is not None:
+            if self.write_thread.is_alive():
+                return eventtime + .100
+            last_error = self.write_error
+            if not self._check_write_thread():
+                if last_error != self.reported_error:
+                    self.reported_error = last_error
+                    self.gcode.respond_info(last_error)
+                return eventtime + WRITE_RETRY_TIME
+            self.reported_error = None
+        if not self.is_dirty:
+            return self.reactor.NEVER
+        self.is_dirty = False
+        self.write_thread = threading.Thread(
+            target=self._write_thread, args=(self._build_file_data(),))
+        self.write_thread.daemon = True
+        self.write_thread.start()
+        # Check the result once the write completes
+        return eventtime + .100
+    def flush(self):
+        # Synchronously write any pending changes to disk
+        if self.write_thread is not None:
+            self._check_write_thread()
+        if self.is_dirty:
+            self._write_file(self._build_file_data())
+            self.is_dirty = False
+            self.write_error = self.reported_error = None
+    def _handle_shutdown(self):
+        if self.is_dirty:
+            self.reactor.update_timer(self.write_timer, self.reactor.NOW)
+    def _handle_disconnect(self):
+        try:
+            self.flush()
+        except:
+            logging.exception("Unable to save variables")
     cmd_SAVE_VARIABLE_help = "Save arbitrary variables to disk"
     def cmd_SAVE_VARIABLE(self, gcmd):
         varname = gcmd.get('VARIABLE')
@@ -43,20 +126,21 @@ class SaveVariables:
             raise gcmd.error("Unable to parse '%s' as a literal" % (value,))
         newvars = dict(self.allVariables)
         newvars[varname] = value
-        # Write file
-        varfile = configparser.ConfigParser()
-        varfile.add_section('Variables')
-        for name, val in sorted(newvars.items()):
-            varfile.set('Variables', name, repr(val))
-        try:
-            f = open(self.filename, "w")
-            varfile.write(f)
-            f.close()
-        except:
-            msg = "Unable to save variable"
-            logging.exception(msg)
-            raise gcmd.error(msg)
-        self.loadVariables()
+        self.allVariables = newvars
+        self.is_dirty = True
+        if not self.save_delay:
+            try:
+                self.flush()
+            except:
+                msg = "Unable to save variable"
+                logging.exception(msg)
+                raise gcmd.error(msg)
+            return
+        # Write the file once the variables stop changing
+        self.reactor.update_timer(self.write_timer,
+                                  self.reactor.monotonic() + self.save_delay)
+        if self.write_error is not None:
+            raise gcmd.error("%s (will retry)" % (self.write_error,))
     def get_status(self, eventtime):
         return {'variables': self.allVariables}
 
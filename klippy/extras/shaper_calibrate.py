@@ -3,13 +3,20 @@
 # Copyright (C) 2020  Dmitry Butyugin <dmbutyugin@google.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import collections, importlib, logging, math, multiprocessing, traceback
+import collections, importlib, logging, math, multiprocessing, queue
+import threading, traceback
 shaper_defs = importlib.import_module('.shaper_defs', 'extras')
 
 MIN_FREQ = 5.
 MAX_FREQ = 200.
 WINDOW_T_SEC = 0.5
+# Incremental frequency response calculation parameters
+RATE_ESTIMATE_T_SEC = 1.
+HOLDBACK_T_SEC = 1.
 MAX_SHAPER_FREQ = 150.
+# Limits of the background frequency response calculation
+MAX_PENDING_MSGS = 100
+MAX_MSGS = 10000
 
 TEST_DAMPING_RATIOS=[0.075, 0.1, 0.15]
 
@@ -69,41 +76,80 @@ class ShaperCalibrate:
                     "installed via `~/klippy-env/bin/pip install` (refer to "
                     "docs/Measuring_Resonances.md for more details).")
 
+    def start_freq_response(self):
+        return FreqResponseClient(self)
+
     def background_process_exec(self, method, args):
-        if self.printer is None:
-            return method(*args)
+        return self.background_process_map(method, [args])[0]
+
+    def background_process_map(self, method, args_list):
+        # Evaluate method(*args) for each entry in args_list, sharding the
+        # calls over one background process per available core
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            return [method(*args) for args in args_list]
         import queuelogger
-        parent_conn, child_conn = multiprocessing.Pipe()
-        def wrapper():
+        ctx = multiprocessing.get_context('fork')
+        num_procs = max(1, min(len(args_list), multiprocessing.cpu_count()))
+        def wrapper(jobs, child_conn):
             queuelogger.clear_bg_logging()
             try:
-                res = method(*args)
+                res = [(i, method(*args_list[i])) for i in jobs]
             except:
                 child_conn.send((True, traceback.format_exc()))
                 child_conn.close()
                 return
             child_conn.send((False, res))
             child_conn.close()
-        # Start a process to perform the calculation
-        calc_proc = multiprocessing.Process(target=wrapper)
-        calc_proc.daemon = True
-        calc_proc.start()
-        # Wait for the process to finish
-        reactor = self.printer.get_reactor()
-        gcode = self.printer.lookup_object("gcode")
-        eventtime = last_report_time = reactor.monotonic()
-        while calc_proc.is_alive():
-            if eventtime > last_report_time + 5.:
-                last_report_time = eventtime
-                gcode.respond_info("Wait for calculations..", log=False)
-            eventtime = reactor.pause(eventtime + .1)
+        # Start processes to perform the calculation
+        calc_procs = []
+        for p in range(num_procs):
+            parent_conn, child_conn = ctx.Pipe()
+            jobs = list(range(p, len(args_list), num_procs))
+            calc_proc = ctx.Process(target=wrapper, args=(jobs, child_conn))
+            calc_proc.daemon = True
+            calc_proc.start()
+            # Only the child holds the sending end, so that the pipe
+            # reports EOF if the process exits without a result
+            child_conn.close()
+            calc_procs.append((calc_proc, parent_conn))
+        def recv_result(parent_conn):
+            try:
+                return parent_conn.recv()
+            except EOFError:
+                return (True, "Process exited")
+        # Wait for the processes to finish
+        pending = list(calc_procs)
+        proc_results = []
+        if self.printer is None:
+            for calc_proc, parent_conn in pending:
+                proc_results.append(recv_result(parent_conn))
+        else:
+            reactor = self.printer.get_reactor()
+            gcode = self.printer.lookup_object("gcode")
+            eventtime = last_report_time = reactor.monotonic()
+            while pending:
+                for calc_proc, parent_conn in list(pending):
+                    # poll() also reports EOF if the process has exited
+                    if parent_conn.poll():
+                        proc_results.append(recv_result(parent_conn))
+                        pending.remove((calc_proc, parent_conn))
+                if not pending:
+                    break
+                if eventtime > last_report_time + 5.:
+                    last_report_time = eventtime
+                    gcode.respond_info("Wait for calculations..", log=False)
+                eventtime = reactor.pause(eventtime + .1)
+        for calc_proc, parent_conn in calc_procs:
+            calc_proc.join()
+            parent_conn.close()
         # Return results
-        is_err, res = parent_conn.recv()
-        if is_err:
-            raise self.error("Error in remote calculation: %s" % (res,))
-        calc_proc.join()
-        parent_conn.close()
-        return res
+        results = [None] * len(args_list)
+        for is_err, res in proc_results:
+            if is_err:
+                raise self.error("Error in remote calculation: %s" % (res,))
+            for i, r in res:
+                results[i] = r
+        return results
 
     def _split_into_windows(self, x, window_size, overlap):
         # Memory-efficient algorithm to split an input 'x' into a series
@@ -115,12 +161,11 @@ class ShaperCalibrate:
         return self.numpy.lib.stride_tricks.as_strided(
                 x, shape=shape, strides=strides, writeable=False)
 
-    def _psd(self, x, fs, nfft):
-        # Calculate power spectral density (PSD) using Welch's algorithm
+    def _window_power_sum(self, x, nfft):
+        # Sum the power spectra of the overlapping windows of size nfft
+        # of 'x' (the first step of Welch's algorithm)
         np = self.numpy
         window = np.kaiser(nfft, 6.)
-        # Compensation for windowing loss
-        scale = 1.0 / (window**2).sum()
 
         # Split into overlapping windows of size nfft
         overlap = nfft // 2
@@ -132,19 +177,32 @@ class ShaperCalibrate:
         # Calculate frequency response for each window using FFT
         result = np.fft.rfft(x, n=nfft, axis=0)
         result = np.conjugate(result) * result
-        result *= scale / fs
+        return result.real.sum(axis=-1), x.shape[-1]
+
+    def _finish_psd(self, power_sum, n_windows, fs, nfft):
+        np = self.numpy
+        # Compensation for windowing loss
+        scale = 1.0 / (np.kaiser(nfft, 6.)**2).sum()
+        # Welch's algorithm: average response over windows
+        psd = power_sum * (scale / (fs * n_windows))
         # For one-sided FFT output the response must be doubled, except
         # the last point for unpaired Nyquist frequency (assuming even nfft)
         # and the 'DC' term (0 Hz)
-        result[1:-1,:] *= 2.
-
-        # Welch's algorithm: average response over windows
-        psd = result.real.mean(axis=-1)
+        psd[1:-1] *= 2.
 
         # Calculate the frequency bins
         freqs = np.fft.rfftfreq(nfft, 1. / fs)
         return freqs, psd
 
+    def _psd(self, x, fs, nfft):
+        # Calculate power spectral density (PSD) using Welch's algorithm
+        power_sum, n_windows = self._window_power_sum(x, nfft)
+        return self._finish_psd(power_sum, n_windows, fs, nfft)
+
+    def get_window_size(self, sampling_freq):
+        # Round up to the nearest power of 2 for faster FFT
+        return 1 << int(sampling_freq * WINDOW_T_SEC - 1).bit_length()
+
     def calc_freq_response(self, raw_values):
         np = self.numpy
         if raw_values is None:
@@ -153,15 +211,15 @@ class ShaperCalibrate:
             data = raw_values
         else:
             samples = raw_values.get_samples()
-            if not samples:
+            if not len(samples):
                 return None
-            data = np.array(samples)
+            # Avoid copying memory-mapped captures
+            data = np.asarray(samples)
 
         N = data.shape[0]
         T = data[-1,0] - data[0,0]
         SAMPLING_FREQ = N / T
-        # Round up to the nearest power of 2 for faster FFT
-        M = 1 << int(SAMPLING_FREQ * WINDOW_T_SEC - 1).bit_length()
+        M = self.get_window_size(SAMPLING_FREQ)
         if N <= M:
             return None
 
@@ -195,6 +253,27 @@ class ShaperCalibrate:
         C = W * np.cos(np.outer(omega_d, T))
         return np.sqrt(S.sum(axis=1)**2 + C.sum(axis=1)**2) * inv_D
 
+    def _estimate_shapers(self, shapers, test_damping_ratio, test_freqs):
+        # Vectorized _estimate_shaper() for a list of shapers that have
+        # the same number of pulses.  Returns an array of shape
+        # (len(shapers), len(test_freqs)).
+        np = self.numpy
+
+        A = np.array([shaper[0] for shaper in shapers])
+        T = np.array([shaper[1] for shaper in shapers])
+        inv_D = 1. / A.sum(axis=1)
+
+        omega = 2. * math.pi * test_freqs
+        damping = test_damping_ratio * omega
+        omega_d = omega * math.sqrt(1. - test_damping_ratio**2)
+        # Broadcast over (shaper, test frequency, pulse)
+        W = A[:,None,:] * np.exp(-damping[None,:,None]
+                                 * (T[:,-1:] - T)[:,None,:])
+        phase = omega_d[None,:,None] * T[:,None,:]
+        S = (W * np.sin(phase)).sum(axis=-1)
+        C = (W * np.cos(phase)).sum(axis=-1)
+        return np.sqrt(S**2 + C**2) * inv_D[:,None]
+
     def _estimate_remaining_vibrations(self, shaper, test_damping_ratio,
                                        freq_bins, psd):
         vals = self._estimate_shaper(shaper, test_damping_ratio, freq_bins)
@@ -236,38 +315,54 @@ class ShaperCalibrate:
         psd = calibration_data.psd_sum[freq_bins <= MAX_FREQ]
         freq_bins = freq_bins[freq_bins <= MAX_FREQ]
 
-        best_res = None
-        results = []
+        # Generate the candidate shapers, starting from the highest
+        # frequency, until the smoothing gets too large
+        shapers = []
+        smoothings = []
         for test_freq in test_freqs[::-1]:
-            shaper_vibrations = 0.
-            shaper_vals = np.zeros(shape=freq_bins.shape)
             shaper = shaper_cfg.init_func(
                     test_freq, shaper_defs.DEFAULT_DAMPING_RATIO)
             shaper_smoothing = self._get_shaper_smoothing(shaper)
-            if max_smoothing and shaper_smoothing > max_smoothing and best_res:
-                return best_res
-            # Exact damping ratio of the printer is unknown, pessimizing
-            # remaining vibrations over possible damping values
-            for dr in TEST_DAMPING_RATIOS:
-                vibrations, vals = self._estimate_remaining_vibrations(
-                        shaper, dr, freq_bins, psd)
-                shaper_vals = np.maximum(shaper_vals, vals)
-                if vibrations > shaper_vibrations:
-                    shaper_vibrations = vibrations
+            if max_smoothing and shaper_smoothing > max_smoothing and shapers:
+                break
+            shapers.append(shaper)
+            smoothings.append(shaper_smoothing)
+        is_truncated = len(shapers) < len(test_freqs)
+        # Exact damping ratio of the printer is unknown, pessimizing
+        # remaining vibrations over possible damping values
+        vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
+        all_vibrations = np.maximum(psd - vibr_threshold, 0).sum()
+        shaper_vals = np.zeros(shape=(len(shapers), freq_bins.shape[0]))
+        shaper_vibrations = np.zeros(shape=len(shapers))
+        for dr in TEST_DAMPING_RATIOS:
+            vals = self._estimate_shapers(shapers, dr, freq_bins)
+            remaining_vibrations = np.maximum(
+                    vals * psd - vibr_threshold, 0).sum(axis=1)
+            shaper_vals = np.maximum(shaper_vals, vals)
+            shaper_vibrations = np.maximum(
+                    shaper_vibrations, remaining_vibrations / all_vibrations)
+
+        best_res = None
+        results = []
+        for i, shaper in enumerate(shapers):
             max_accel = self.find_shaper_max_accel(shaper)
             # The score trying to minimize vibrations, but also accounting
             # the growth of smoothing. The formula itself does not have any
             # special meaning, it simply shows good results on real user data
-            shaper_score = shaper_smoothing * (shaper_vibrations**1.5 +
-                                               shaper_vibrations * .2 + .01)
+            vibrations = shaper_vibrations[i]
+            shaper_score = smoothings[i] * (vibrations**1.5 +
+                                            vibrations * .2 + .01)
             results.append(
                     CalibrationResult(
-                        name=shaper_cfg.name, freq=test_freq, vals=shaper_vals,
-                        vibrs=shaper_vibrations, smoothing=shaper_smoothing,
-                        score=shaper_score, max_accel=max_accel))
+                        name=shaper_cfg.name, freq=test_freqs[-1-i],
+                        vals=shaper_vals[i], vibrs=vibrations,
+                        smoothing=smoothings[i], score=shaper_score,
+                        max_accel=max_accel))
             if best_res is None or best_res.vibrs > results[-1].vibrs:
                 # The current frequency is better for the shaper.
                 best_res = results[-1]
+        if is_truncated:
+            return best_res
         # Try to find an 'optimal' shapper configuration: the one that is not
         # much worse than the 'best' one, but gives much less smoothing
         selected = best_res
@@ -276,38 +371,41 @@ class ShaperCalibrate:
                 selected = res
         return selected
 
-    def _bisect(self, func):
-        left = right = 1.
-        while not func(left):
-            right = left
-            left *= .5
-        if right == left:
-            while func(right):
-                right *= 2.
-        while right - left > 1e-8:
-            middle = (left + right) * .5
-            if func(middle):
-                left = middle
-            else:
-                right = middle
-        return left
-
-    def find_shaper_max_accel(self, shaper):
+    def find_shaper_max_accel(self, shaper, scv=5.):
         # Just some empirically chosen value which produces good projections
         # for max_accel without much smoothing
         TARGET_SMOOTHING = 0.12
-        max_accel = self._bisect(lambda test_accel: self._get_shaper_smoothing(
-            shaper, test_accel) <= TARGET_SMOOTHING)
-        return max_accel
+        # The smoothing (see _get_shaper_smoothing) is the maximum of two
+        # linear functions of the acceleration, so the acceleration that
+        # reaches the target smoothing can be calculated directly
+        A, T = shaper
+        inv_D = 1. / sum(A)
+        n = len(T)
+        ts = sum([A[i] * T[i] for i in range(n)]) * inv_D
+        const_90 = accel_90 = accel_180 = 0.
+        for i in range(n):
+            if T[i] >= ts:
+                const_90 += A[i] * scv * (T[i]-ts)
+                accel_90 += A[i] * .5 * (T[i]-ts)**2
+            accel_180 += A[i] * .5 * (T[i]-ts)**2
+        const_90 *= inv_D * math.sqrt(2.)
+        accel_90 *= inv_D * math.sqrt(2.)
+        accel_180 *= inv_D
+        max_accel = TARGET_SMOOTHING / accel_180
+        if accel_90:
+            max_accel = min(max_accel,
+                            (TARGET_SMOOTHING - const_90) / accel_90)
+        return max(max_accel, 0.)
 
     def find_best_shaper(self, calibration_data, max_smoothing, logger=None):
         best_shaper = None
         all_shapers = []
-        for shaper_cfg in shaper_defs.INPUT_SHAPERS:
-            if shaper_cfg.name not in AUTOTUNE_SHAPERS:
-                continue
-            shaper = self.background_process_exec(self.fit_shaper, (
-                shaper_cfg, calibration_data, max_smoothing))
+        shaper_cfgs = [shaper_cfg for shaper_cfg in shaper_defs.INPUT_SHAPERS
+                       if shaper_cfg.name in AUTOTUNE_SHAPERS]
+        fitted_shapers = self.background_process_map(self.fit_shaper, [
+            (shaper_cfg, calibration_data, max_smoothing)
+            for shaper_cfg in shaper_cfgs])
+        for shaper in fitted_shapers:
             if logger is not None:
                 logger("Fitted shaper '%s' frequency = %.1f Hz "
                        "(vibrations = %.1f%%, smoothing ~= %.3f)" % (
@@ -358,3 +456,238 @@ class ShaperCalibrate:
                     csvfile.write("\n")
         except IOError as e:
             raise self.error("Error writing to file '%s': %s", output, str(e))
+
+
+######################################################################
+# Incremental frequency response calculation
+######################################################################
+
+# Welch's algorithm evaluated on samples as they arrive.  Only the
+# samples of incomplete windows (and the most recent samples, which may
+# still turn out to be past the end of the measurement) are retained.
+class WelchAccumulator:
+    def __init__(self, helper):
+        self.helper = helper
+        self.numpy = helper.numpy
+        self.start_time = None
+        self.pending = []
+        self.samples = None
+        self.nfft = None
+        self.power_sums = [0., 0., 0.]
+        self.n_windows = 0
+        # Count and time range of samples already processed and released
+        self.sample_count = 0
+        self.first_time = self.last_time = None
+    def set_start_time(self, start_time):
+        self.start_time = start_time
+    def add_samples(self, data):
+        data = self.numpy.asarray(data, dtype=float).reshape(-1, 4)
+        if not len(data):
+            return
+        self.pending.append(data)
+        if self.start_time is not None:
+            self._process(self._collect(), data[-1,0] - HOLDBACK_T_SEC)
+    def _collect(self):
+        np = self.numpy
+        if not self.pending:
+            return self.samples
+        if self.samples is not None:
+            self.pending.insert(0, self.samples)
+        data = np.concatenate(self.pending)
+        self.pending = []
+        if self.first_time is None:
+            data = data[data[:,0] >= self.start_time]
+            if len(data):
+                self.first_time = data[0,0]
+        self.samples = data
+        return data
+    def _add_windows(self, data, count):
+        # Process all complete windows in the first 'count' samples
+        nfft = self.nfft
+        overlap = nfft // 2
+        step = nfft - overlap
+        if count < nfft:
+            return
+        n_windows = (count - overlap) // step
+        end = (n_windows - 1) * step + nfft
+        for i in range(3):
+            power_sum, n = self.helper._window_power_sum(data[:end,i+1], nfft)
+            self.power_sums[i] = self.power_sums[i] + power_sum
+        self.n_windows += n_windows
+        released = n_windows * step
+        self.sample_count += released
+        self.last_time = data[released-1,0]
+        self.samples = data[released:]
+    def _process(self, data, commit_time):
+        if data is None or not len(data):
+            return
+        if self.nfft is None:
+            # Estimate the sampling rate in order to select the window size
+            T = data[-1,0] - data[0,0]
+            if T < RATE_ESTIMATE_T_SEC:
+                return
+            self.nfft = self.helper.get_window_size(len(data) / T)
+        count = self.numpy.searchsorted(data[:,0], commit_time, 'right')
+        self._add_windows(data, count)
+    def finish(self, end_time):
+        data = self._collect()
+        if data is None:
+            return None
+        data = data[data[:,0] <= end_time]
+        N = self.sample_count + len(data)
+        if not N:
+            return None
+        last_time = data[-1,0] if len(data) else self.last_time
+        T = last_time - self.first_time
+        if T <= 0.:
+            return None
+        fs = N / T
+        if self.nfft is None:
+            self.nfft = self.helper.get_window_size(fs)
+        if N <= self.nfft:
+            return None
+        self._add_windows(data, len(data))
+        if not self.n_windows:
+            return None
+        psds = [self.helper._finish_psd(power_sum, self.n_windows, fs,
+                                        self.nfft)
+                for power_sum in self.power_sums]
+        (fx, px), (fy, py), (fz, pz) = psds
+        return CalibrationData(fx, px+py+pz, px, py, pz)
+
+def _handle_accumulator_cmd(accumulator, cmd, arg):
+    if cmd == 'start':
+        accumulator.set_start_time(arg)
+    elif cmd == 'data':
+        accumulator.add_samples(arg)
+
+# An internal webhooks client (see motion_report.APIDumpHelper) that
+# calculates the frequency response of the received accelerometer
+# samples in a background process while the measurement is running.
+# Messages are handed to the process by a sender thread so that a slow
+# process can not block the reactor.
+class FreqResponseClient:
+    def __init__(self, helper):
+        self.helper = helper
+        self.printer = helper.printer
+        self.is_done = False
+        self.error = None
+        self.msg_count = 0
+        self.accumulator = self.proc = self.sender = None
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            self.accumulator = WelchAccumulator(helper)
+            return
+        ctx = multiprocessing.get_context('fork')
+        self.parent_conn, child_conn = ctx.Pipe()
+        self.proc = ctx.Process(target=self._worker, args=(child_conn,))
+        self.proc.daemon = True
+        self.proc.start()
+        child_conn.close()
+        self.send_queue = queue.Queue(MAX_PENDING_MSGS)
+        self.sender = threading.Thread(target=self._sender)
+        self.sender.daemon = True
+        self.sender.start()
+    def _worker(self, conn):
+        import queuelogger
+        queuelogger.clear_bg_logging()
+        self.parent_conn.close()
+        accumulator = WelchAccumulator(self.helper)
+        try:
+            while 1:
+                cmd, arg = conn.recv()
+                if cmd == 'finish':
+                    conn.send((False, accumulator.finish(arg)))
+                    break
+                _handle_accumulator_cmd(accumulator, cmd, arg)
+        except EOFError:
+            pass
+        except:
+            conn.send((True, traceback.format_exc()))
+        conn.close()
+    def _sender(self):
+        while 1:
+            item = self.send_queue.get()
+            if item is None:
+                break
+            try:
+                self.parent_conn.send(item)
+            except (IOError, OSError):
+                self.error = "Background process exited"
+                self.is_done = True
+                break
+            if item[0] == 'finish':
+                break
+    def _send(self, cmd, arg):
+        if self.error is not None:
+            return
+        if self.proc is None:
+            _handle_accumulator_cmd(self.accumulator, cmd, arg)
+            return
+        try:
+            self.send_queue.put_nowait((cmd, arg))
+        except queue.Full:
+            self.error = "Background calculation is too slow"
+            self.is_done = True
+    def set_start_time(self, start_time):
+        self._send('start', start_time)
+    # Internal client interface
+    def send(self, msg):
+        self._send('data', msg['params']['data'])
+        self.msg_count += 1
+        if self.msg_count >= MAX_MSGS:
+            # Avoid running the calculation for too long
+            self.finalize()
+    def get_messages(self):
+        return []
+    def finalize(self):
+        self.is_done = True
+    def is_closed(self):
+        return self.is_done
+    # Stop the background process (if it is still running)
+    def close(self):
+        self.is_done = True
+        if self.proc is None:
+            return
+        if self.sender.is_alive():
+            try:
+                self.send_queue.put_nowait(None)
+            except queue.Full:
+                pass
+        self.proc.terminate()
+        self.proc.join()
+        # Sends to the terminated process fail, stopping the sender
+        self.sender.join()
+        self.parent_conn.close()
+        self.proc = None
+    # Obtain the results of the measurement
+    def get_calibration_data(self, end_time):
+        self.is_done = True
+        if self.proc is None:
+            calibration_data = self.accumulator.finish(end_time)
+        else:
+            calibration_data = self._wait_result(end_time)
+        if calibration_data is not None:
+            calibration_data.set_numpy(self.helper.numpy)
+        return calibration_data
+    def _wait_result(self, end_time):
+        self._send('finish', end_time)
+        conn = self.parent_conn
+        res = None
+        if self.printer is not None:
+            reactor = self.printer.get_reactor()
+            eventtime = reactor.monotonic()
+            while (self.error is None and not conn.poll()
+                   and self.proc.is_alive()):
+                eventtime = reactor.pause(eventtime + .1)
+        if self.error is None:
+            try:
+                is_err, res = conn.recv()
+            except EOFError:
+                is_err, res = True, "Background process exited"
+            if is_err:
+                self.error = res
+        self.close()
+        if self.error is not None:
+            raise self.helper.error(
+                    "Error in remote calculation: %s" % (self.error,))
+        return res
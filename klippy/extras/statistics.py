@@ -11,6 +11,7 @@ class PrinterSysStats:
         self.last_process_time = self.total_process_time = 0.
         self.last_load_avg = 0.
         self.last_mem_avail = 0
+        self.reactor = printer.get_reactor()
         self.mem_file = None
         try:
             self.mem_file = open("/proc/meminfo", "r")
@@ -43,6 +44,10 @@ class PrinterSysStats:
                         break
             except:
                 pass
+        # Get reactor async callback stats
+        async_msg = self.reactor.get_async_stats()
+        if async_msg:
+            msg = "%s %s" % (msg, async_msg)
         return (False, msg)
     def get_status(self, eventtime):
         return {'sysload': self.last_load_avg,
@@ -10,6 +10,7 @@ import math# math library is not used. Consider removing this import.
 import os
 import struct
 import textwrap
+import time
 import jinja2
 import mcu
 from . import var, page, routine, dgus_reloaded
@@ -114,10 +115,11 @@ class T5UID1GCodeMacro:
                                       extensions=['jinja2.ext.do'])
 
     def load_template(self, config, option, default=None):
-        """Load applicable jinja2 template"""
+        """Load applicable jinja2 template (syntax checked now, compiled on first use)"""
         name = f"{config.get_name()}:{option}"
         script = config.get(option, default) if default is not None else config.get(option)
-        return gcode_macro.TemplateWrapper(self.printer, self.env, name, script)
+        return gcode_macro.TemplateWrapper(self.printer, self.env, name, script,
+                                           lazy=True)
 
 class T5UID1:
     """Defines one instance of the t5uid1 class as a unique set of parameters/attributes"""
@@ -315,10 +317,13 @@ class T5UID1:
             filepath = os.path.join(os.path.dirname(__file__),
                                     self._firmware,
                                     fname)
+            start_time = time.perf_counter()
             try:
                 dconfig = self.configfile.read_config(filepath)
             except Exception as e:
                 raise self.printer.config_error(f"Cannot load config '{filepath}'") from e
+            self.printer.get_startup_profiler().note(
+                'config', filepath, time.perf_counter() - start_time)
             v_list += [c for c in dconfig.get_prefix_sections('t5uid1_var ')
                        if c.get_name() not in v_main_names]
             p_list += [c for c in dconfig.get_prefix_sections('t5uid1_page ')
@@ -947,7 +952,7 @@ class T5UID1:
 
     def limit_extrude(self, extruder, val):
         """ Ensure filament_length value !> max_extrude_only_distance in printer.cfg"""
-        logging.exception("Entering t5uid1.limit_extrude with val = : %s", str(val))
+        logging.debug("Entering t5uid1.limit_extrude with val = : %s", val)
         try:
             if extruder in self.extruders:
                 res = self.extruders[extruder].max_e_dist
@@ -3,10 +3,80 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging, io
+import os, logging, io, threading, queue
+from . import gcode_cache
 
 VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
 
+# Helper to read and split a g-code file into lines
+class TextReader:
+    def __init__(self, fileobj, chunk_size, owns_file=False):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.owns_file = owns_file
+        self.partial_input = ""
+    def read_batch(self):
+        # Returns a list of lines (in reverse order) or None on end of file
+        data = self.fileobj.read(self.chunk_size)
+        if not data:
+            return None
+        lines = data.split('\n')
+        lines[0] = self.partial_input + lines[0]
+        self.partial_input = lines.pop()
+        lines.reverse()
+        return lines
+    def close(self):
+        if self.owns_file:
+            self.fileobj.close()
+
+# Helper to read batches of lines from a background thread.  The
+# thread takes ownership of the line source and closes it on exit.
+class ReadAheadReader:
+    def __init__(self, source, queue_size):
+        self.source = source
+        self.queue = queue.Queue(queue_size)
+        self.error = False
+        self.stop_request = False
+        self.bg_thread = threading.Thread(target=self._bg_thread)
+        self.bg_thread.daemon = True
+        self.bg_thread.start()
+    def _put(self, item):
+        while not self.stop_request:
+            try:
+                self.queue.put(item, timeout=0.100)
+                return
+            except queue.Full:
+                pass
+    def _bg_thread(self):
+        try:
+            while not self.stop_request:
+                try:
+                    lines = self.source.read_batch()
+                except:
+                    logging.exception("virtual_sdcard read-ahead")
+                    self.error = True
+                    lines = None
+                self._put(lines)
+                if lines is None:
+                    # End of file (or read error)
+                    break
+        finally:
+            try:
+                self.source.close()
+            except:
+                logging.exception("virtual_sdcard read-ahead close")
+    def get_lines(self):
+        # Returns a list of lines, None on end of file, or raises
+        # queue.Empty if the background thread has not caught up
+        lines = self.queue.get_nowait()
+        if lines is None and self.error:
+            raise IOError("virtual_sdcard read-ahead error")
+        return lines
+    def stop(self):
+        # The thread exits (without blocking the caller) once any
+        # pending read completes
+        self.stop_request = True
+
 class VirtualSD:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -24,6 +94,17 @@ class VirtualSD:
         self.must_pause_work = self.cmd_from_sd = False
         self.next_file_position = 0
         self.work_timer = None
+        # File reading
+        self.read_chunk_size = config.getint('read_chunk_size', 8192,
+                                             minval=512)
+        self.read_ahead_chunks = config.getint('read_ahead_chunks', 0,
+                                               minval=0)
+        self.line_source = self.reader = None
+        self.stall_time = 0.
+        self.gcode_cache = None
+        if config.getboolean('gcode_cache', False):
+            self.gcode_cache = gcode_cache.GCodeCache(
+                config, self.sdcard_dirname)
         # Error handling
         gcode_macro = self.printer.load_object(config, 'gcode_macro')
         self.on_error_gcode = gcode_macro.load_template(
@@ -40,9 +121,14 @@ class VirtualSD:
         self.gcode.register_command(
             "SDCARD_PRINT_FILE", self.cmd_SDCARD_PRINT_FILE,
             desc=self.cmd_SDCARD_PRINT_FILE_help)
+        if self.gcode_cache is not None:
+            self.gcode.register_command(
+                "SDCARD_PRECOMPILE", self.cmd_SDCARD_PRECOMPILE,
+                desc=self.cmd_SDCARD_PRECOMPILE_help)
     def handle_shutdown(self):
         if self.work_timer is not None:
             self.must_pause_work = True
+            self._stop_reader()
             try:
                 readpos = max(self.file_position - 1024, 0)
                 readcount = self.file_position - readpos
@@ -57,7 +143,8 @@ class VirtualSD:
     def stats(self, eventtime):
         if self.work_timer is None:
             return False, ""
-        return True, "sd_pos=%d" % (self.file_position,)
+        return True, "sd_pos=%d sd_stall=%.3f" % (self.file_position,
+                                                   self.stall_time)
     def get_file_list(self, check_subdirs=False):
         if check_subdirs:
             flist = []
@@ -149,6 +236,21 @@ class VirtualSD:
             filename = filename[1:]
         self._load_file(gcmd, filename, check_subdirs=True)
         self.do_resume()
+    cmd_SDCARD_PRECOMPILE_help = "Generate the gcode cache for a SD file"
+    def cmd_SDCARD_PRECOMPILE(self, gcmd):
+        filename = gcmd.get("FILENAME")
+        if filename[0] == '/':
+            filename = filename[1:]
+        files = self.get_file_list(check_subdirs=True)
+        files_by_lower = { fname.lower(): fname for fname, fsize in files }
+        fname = files_by_lower.get(filename.lower())
+        if fname is None:
+            raise gcmd.error("Unable to open file")
+        src_filename = os.path.join(self.sdcard_dirname, fname)
+        if not self.gcode_cache.compile(src_filename, fname):
+            raise gcmd.error("Unable to generate gcode cache for %s"
+                             % (fname,))
+        gcmd.respond_info("Generated gcode cache for %s" % (fname,))
     def cmd_M20(self, gcmd):
         # List SD card
         files = self.get_file_list()
@@ -215,6 +317,69 @@ class VirtualSD:
         self.next_file_position = pos
     def is_cmd_from_sd(self):
         return self.cmd_from_sd
+    # File reading
+    def _get_cache_name(self):
+        return self.current_file.name[len(self.sdcard_dirname) + 1:]
+    def _start_reader(self):
+        source = None
+        if self.gcode_cache is not None:
+            source = self.gcode_cache.open_reader(
+                self.current_file.name, self._get_cache_name(),
+                self.file_position)
+            if source is None:
+                self.gcode_cache.start_compile(self.current_file.name,
+                                               self._get_cache_name())
+        read_ahead = self.read_ahead_chunks
+        if source is None and read_ahead:
+            # The read-ahead thread uses its own file object so that it
+            # does not need to be joined before the file is used again
+            try:
+                fileobj = io.open(self.current_file.name, 'r', newline='')
+                fileobj.seek(self.file_position)
+                source = TextReader(fileobj, self.read_chunk_size,
+                                    owns_file=True)
+            except:
+                logging.exception("virtual_sdcard read-ahead open")
+                read_ahead = 0
+        if source is None:
+            self.current_file.seek(self.file_position)
+            source = TextReader(self.current_file, self.read_chunk_size)
+        if read_ahead:
+            self.reader = ReadAheadReader(source, read_ahead)
+        else:
+            self.line_source = source
+    def _stop_reader(self):
+        if self.reader is not None:
+            self.reader.stop()
+            self.reader = None
+        if self.line_source is not None:
+            self.line_source.close()
+            self.line_source = None
+    def _read_lines(self):
+        # Returns the next batch of lines (in reverse order), or None on
+        # end of file.  Time spent waiting on storage is tracked.
+        reader = self.reader
+        if reader is None:
+            starttime = self.reactor.monotonic()
+            lines = self.line_source.read_batch()
+            self.stall_time += self.reactor.monotonic() - starttime
+            return lines
+        try:
+            return reader.get_lines()
+        except queue.Empty:
+            pass
+        starttime = self.reactor.monotonic()
+        while not self.must_pause_work:
+            self.reactor.pause(self.reactor.monotonic() + 0.001)
+            try:
+                lines = reader.get_lines()
+                break
+            except queue.Empty:
+                pass
+        else:
+            lines = []
+        self.stall_time += self.reactor.monotonic() - starttime
+        return lines
     # Background work timer
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
@@ -227,28 +392,25 @@ class VirtualSD:
             return self.reactor.NEVER
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
+        self._start_reader()
         lines = []
         error_message = None
         while not self.must_pause_work:
             if not lines:
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    lines = self._read_lines()
                 except:
                     logging.exception("virtual_sdcard read")
                     break
-                if not data:
+                if lines is None:
                     # End of file
+                    self._stop_reader()
                     self.current_file.close()
                     self.current_file = None
                     logging.info("Finished SD card print")
                     self.gcode.respond_raw("Done printing file")
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
                 self.reactor.pause(self.reactor.NOW)
                 continue
             # Pause if any other request is pending in the gcode class
@@ -258,10 +420,17 @@ class VirtualSD:
             # Dispatch command
             self.cmd_from_sd = True
             line = lines.pop()
-            next_file_position = self.file_position + len(line) + 1
+            if type(line) is str:
+                next_file_position = self.file_position + len(line) + 1
+            else:
+                # Pre-parsed line from the gcode cache
+                next_file_position = self.file_position + line[0]
             self.next_file_position = next_file_position
             try:
-                self.gcode.run_script(line)
+                if type(line) is str:
+                    self.gcode.run_script(line)
+                elif len(line) > 1:
+                    self.gcode.run_parsed_command(*line[1:])
             except self.gcode.error as e:
                 error_message = str(e)
                 try:
@@ -276,6 +445,7 @@ class VirtualSD:
             self.file_position = self.next_file_position
             # Do we need to skip around?
             if self.next_file_position != next_file_position:
+                self._stop_reader()
                 try:
                     self.current_file.seek(self.file_position)
                 except:
@@ -283,8 +453,9 @@ class VirtualSD:
                     self.work_timer = None
                     return self.reactor.NEVER
                 lines = []
-                partial_input = ""
+                self._start_reader()
         logging.info("Exiting SD card print (position %d)", self.file_position)
+        self._stop_reader()
         self.work_timer = None
         self.cmd_from_sd = False
         if error_message is not None:
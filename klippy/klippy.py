@@ -47,6 +47,31 @@ config, and restart the host software.
 Printer is shutdown
 """
 
+# Record the time spent in each stage of loading the config
+class StartupProfiler:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.start_time = time.perf_counter()
+        self.entries = []
+    def note(self, category, name, duration):
+        if self.enabled:
+            self.entries.append((duration, category, name))
+    def log_report(self, max_entries=20):
+        if not self.enabled:
+            return
+        self.enabled = False
+        categories = collections.OrderedDict()
+        for entry in sorted(self.entries, reverse=True):
+            categories.setdefault(entry[1], []).append(entry)
+        out = ["Startup profile (%.3fs total):"
+               % (time.perf_counter() - self.start_time,)]
+        for category, entries in sorted(categories.items()):
+            out.append("%s: %d in %.3fs" % (
+                category, len(entries), sum([e[0] for e in entries])))
+            for duration, category, name in entries[:max_entries]:
+                out.append("  %.6f %s" % (duration, name))
+        logging.info("\n".join(out))
+
 class Printer:
     config_error = configfile.error
     command_error = gcode.CommandError
@@ -60,11 +85,16 @@ class Printer:
         self.run_result = None
         self.event_handlers = {}
         self.objects = collections.OrderedDict()
+        self.extras_modules = None
+        self.startup_profiler = StartupProfiler(
+            start_args.get('profile_startup', False))
         # Init printer components that must be setup prior to config
         for m in [gcode, webhooks]:
             m.add_early_printer_objects(self)
     def get_start_args(self):
         return self.start_args
+    def get_startup_profiler(self):
+        return self.startup_profiler
     def get_reactor(self):
         return self.reactor
     def get_state_message(self):
@@ -110,15 +140,18 @@ class Printer:
             return self.objects[section]
         module_parts = section.split()
         module_name = module_parts[0]
-        py_name = os.path.join(os.path.dirname(__file__),
-                               'extras', module_name + '.py')
-        py_dirname = os.path.join(os.path.dirname(__file__),
-                                  'extras', module_name, '__init__.py')
-        if not os.path.exists(py_name) and not os.path.exists(py_dirname):
+        if module_name not in self._get_extras_modules():
             if default is not configfile.sentinel:
                 return default
             raise self.config_error("Unable to load module '%s'" % (section,))
-        mod = importlib.import_module('extras.' + module_name)
+        mod_name = 'extras.' + module_name
+        if mod_name in sys.modules:
+            mod = sys.modules[mod_name]
+        else:
+            start_time = time.perf_counter()
+            mod = importlib.import_module(mod_name)
+            self.startup_profiler.note('import', mod_name,
+                                       time.perf_counter() - start_time)
         init_func = 'load_config'
         if len(module_parts) > 1:
             init_func = 'load_config_prefix'
@@ -127,8 +160,25 @@ class Printer:
             if default is not configfile.sentinel:
                 return default
             raise self.config_error("Unable to load module '%s'" % (section,))
+        start_time = time.perf_counter()
         self.objects[section] = init_func(config.getsection(section))
+        self.startup_profiler.note('init', section,
+                                   time.perf_counter() - start_time)
         return self.objects[section]
+    def _get_extras_modules(self):
+        # Scan the extras directory once (instead of checking the
+        # filesystem for every config section)
+        if self.extras_modules is None:
+            extras_dir = os.path.join(os.path.dirname(__file__), 'extras')
+            modules = set()
+            for fname in os.listdir(extras_dir):
+                if fname.endswith('.py'):
+                    modules.add(fname[:-3])
+                elif os.path.exists(os.path.join(extras_dir, fname,
+                                                 '__init__.py')):
+                    modules.add(fname)
+            self.extras_modules = modules
+        return self.extras_modules
     def _read_config(self):
         self.objects['configfile'] = pconfig = configfile.PrinterConfig(self)
         config = pconfig.read_main_config()
@@ -171,13 +221,20 @@ class Printer:
         msg += [message_protocol_error2, str(e)]
         return "\n".join(msg)
     def _connect(self, eventtime):
+        profiler = self.startup_profiler
         try:
+            start_time = time.perf_counter()
             self._read_config()
+            connect_time = time.perf_counter()
+            profiler.note('startup', 'read_config', connect_time - start_time)
             self.send_event("klippy:mcu_identify")
             for cb in self.event_handlers.get("klippy:connect", []):
                 if self.state_message is not message_startup:
                     return
                 cb()
+            profiler.note('startup', 'connect',
+                          time.perf_counter() - connect_time)
+            profiler.log_report()
         except (self.config_error, pins.error) as e:
             logging.exception("Config error")
             self._set_state("%s\n%s" % (str(e), message_restart))
@@ -305,6 +362,9 @@ def main():
                     help="input tty name (default is /tmp/printer)")
     opts.add_option("-a", "--api-server", dest="apiserver",
                     help="api server unix domain socket filename")
+    opts.add_option("--api-refresh-time", dest="api_refresh_time",
+                    type="float", help="api subscription update interval"
+                    " in seconds (default is 0.25)")
     opts.add_option("-l", "--logfile", dest="logfile",
                     help="write log to file instead of stderr")
     opts.add_option("-v", action="store_true", dest="verbose",
@@ -318,6 +378,9 @@ def main():
                     help="file to read for mcu protocol dictionary")
     opts.add_option("--import-test", action="store_true",
                     help="perform an import module test")
+    opts.add_option("--profile-startup", action="store_true",
+                    dest="profile_startup",
+                    help="log the time spent loading each config section")
     options, args = opts.parse_args()
     if options.import_test:
         import_test()
@@ -325,6 +388,12 @@ def main():
         opts.error("Incorrect number of arguments")
     start_args = {'config_file': args[0], 'apiserver': options.apiserver,
                   'start_reason': 'startup'}
+    if options.api_refresh_time is not None:
+        if options.api_refresh_time <= 0.:
+            opts.error("Invalid api refresh time")
+        start_args['api_refresh_time'] = options.api_refresh_time
+    if options.profile_startup:
+        start_args['profile_startup'] = True
 
     debuglevel = logging.INFO
     if options.verbose:
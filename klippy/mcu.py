@@ -592,9 +592,6 @@ class MCU:
         # Register handlers
         printer.register_event_handler("klippy:firmware_restart",
                                        self._firmware_restart)
-        printer.register_event_handler("klippy:mcu_identify",
-                                       self._mcu_identify)
-        printer.register_event_handler("klippy:connect", self._connect)
         printer.register_event_handler("klippy:shutdown", self._shutdown)
         printer.register_event_handler("klippy:disconnect", self._disconnect)
     # Serial callbacks
@@ -676,20 +673,17 @@ class MCU:
         if prev_crc is not None and config_crc != prev_crc:
             self._check_restart("CRC mismatch")
             raise error("MCU '%s' CRC does not match config" % (self._name,))
-        # Transmit config messages (if needed)
+        # Encode config messages (if needed) and init messages
         self.register_response(self._handle_starting, 'starting')
+        if prev_crc is None:
+            logging.info("Sending MCU '%s' printer configuration...",
+                         self._name)
+            cmds = self._config_cmds + self._init_cmds
+        else:
+            cmds = self._restart_cmds + self._init_cmds
+        msgparser = self._serial.get_msgparser()
         try:
-            if prev_crc is None:
-                logging.info("Sending MCU '%s' printer configuration...",
-                             self._name)
-                for c in self._config_cmds:
-                    self._serial.send(c)
-            else:
-                for c in self._restart_cmds:
-                    self._serial.send(c)
-            # Transmit init messages
-            for c in self._init_cmds:
-                self._serial.send(c)
+            cmds = [msgparser.create_command(c) for c in cmds]
         except msgproto.enumeration_error as e:
             enum_name, enum_value = e.get_enum_params()
             if enum_name == 'pin':
@@ -698,6 +692,9 @@ class MCU:
                     "Pin '%s' is not a valid pin name on mcu '%s'"
                     % (enum_value, self._name))
             raise
+        # Transmit all messages (the following get_config query waits
+        # for the mcu to process them)
+        self._serial.send_all(cmds)
     def _send_get_config(self):
         get_config_cmd = self.lookup_query_command(
             "get_config",
@@ -756,7 +753,7 @@ class MCU:
         logging.info(move_msg)
         log_info = self._log_info() + "\n" + move_msg
         self._printer.set_rollover_info(self._name, log_info, log=False)
-    def _mcu_identify(self):
+    def _connect_serial(self):
         if self.is_fileoutput():
             self._connect_file()
         else:
@@ -777,6 +774,11 @@ class MCU:
                     self._serial.connect_uart(self._serialport, self._baud, rts)
                 else:
                     self._serial.connect_pipe(self._serialport)
+            except serialhdl.error as e:
+                raise error(str(e))
+    def _mcu_identify(self):
+        if not self.is_fileoutput():
+            try:
                 self._clocksync.connect(self._serial)
             except serialhdl.error as e:
                 raise error(str(e))
@@ -844,8 +846,8 @@ class MCU:
         return self._printer
     def get_name(self):
         return self._name
-    def register_response(self, cb, msg, oid=None):
-        self._serial.register_response(cb, msg, oid)
+    def register_response(self, cb, msg, oid=None, as_tuple=False):
+        self._serial.register_response(cb, msg, oid, as_tuple)
     def alloc_command_queue(self):
         return self._serial.alloc_command_queue()
     def lookup_command(self, msgformat, cq=None):
@@ -1001,14 +1003,76 @@ def error_help(msg):
                 return help_msg
     return ""
 
+# Connect to and configure all the micro-controllers in parallel
+class MCUConnectHelper:
+    def __init__(self, printer, mcus):
+        self._printer = printer
+        self._reactor = printer.get_reactor()
+        self._mcus = mcus
+        printer.register_event_handler("klippy:mcu_identify",
+                                       self._mcu_identify)
+        printer.register_event_handler("klippy:connect", self._connect)
+    def _run_parallel(self, funcs, durations):
+        # Run each function in its own reactor greenlet and wait for all
+        # of them to complete.  The first error is raised as soon as it
+        # occurs, without waiting for the remaining functions.
+        done = self._reactor.completion()
+        pending = [len(funcs)]
+        def wrap(mcu, func):
+            def run(eventtime):
+                try:
+                    func()
+                except Exception as e:
+                    if done.test():
+                        logging.exception("Error connecting to mcu '%s'",
+                                          mcu.get_name())
+                    else:
+                        done.complete(e)
+                finally:
+                    durations[mcu] = durations.get(mcu, 0.) + (
+                        self._reactor.monotonic() - eventtime)
+                pending[0] -= 1
+                if not pending[0] and not done.test():
+                    done.complete(None)
+            return run
+        for mcu, func in funcs:
+            self._reactor.register_callback(wrap(mcu, func))
+        if funcs:
+            e = done.wait()
+            if e is not None:
+                raise e
+    def _log_durations(self, msg, start_time, durations):
+        logging.info("%s %d MCU(s) in %.3fs (%s)", msg, len(self._mcus),
+                     self._reactor.monotonic() - start_time,
+                     " ".join(["%s=%.3f" % (m.get_name(), durations[m])
+                               for m in self._mcus if m in durations]))
+    def _mcu_identify(self):
+        start_time = self._reactor.monotonic()
+        durations = {}
+        self._run_parallel([(m, m._connect_serial) for m in self._mcus],
+                           durations)
+        # Secondary mcus synchronize their clock with the main mcu
+        main_mcu = self._mcus[0]
+        self._run_parallel([(main_mcu, main_mcu._mcu_identify)], durations)
+        self._run_parallel([(m, m._mcu_identify) for m in self._mcus[1:]],
+                           durations)
+        self._log_durations("Connected", start_time, durations)
+    def _connect(self):
+        start_time = self._reactor.monotonic()
+        durations = {}
+        self._run_parallel([(m, m._connect) for m in self._mcus], durations)
+        self._log_durations("Configured", start_time, durations)
+
 def add_printer_objects(config):
     printer = config.get_printer()
     reactor = printer.get_reactor()
     mainsync = clocksync.ClockSync(reactor)
-    printer.add_object('mcu', MCU(config.getsection('mcu'), mainsync))
+    mcus = [MCU(config.getsection('mcu'), mainsync)]
+    printer.add_object('mcu', mcus[0])
     for s in config.get_prefix_sections('mcu '):
-        printer.add_object(s.section, MCU(
-            s, clocksync.SecondarySync(reactor, mainsync)))
+        mcus.append(MCU(s, clocksync.SecondarySync(reactor, mainsync)))
+        printer.add_object(s.section, mcus[-1])
+    MCUConnectHelper(printer, mcus)
 
 def get_printer_mcu(printer, name):
     if name == 'mcu':
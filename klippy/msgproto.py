@@ -153,6 +153,66 @@ def lookup_output_params(msgformat):
         args = args[pos+1:]
     return param_types
 
+# Generate python code that decodes a parameter of the given type
+def gen_parse_code(t, var, namespace):
+    if isinstance(t, Enumeration):
+        code = gen_parse_code(t.pt, "e", namespace)
+        enums_name = "enums_%s" % (var,)
+        namespace[enums_name] = t.reverse_enums
+        code.extend(["%s = %s.get(e)" % (var, enums_name),
+                     "if %s is None:" % (var,),
+                     "    %s = \"?%%d\" %% (e,)" % (var,)])
+        return code
+    if t.is_dynamic_string:
+        return ["l = s[pos]",
+                "%s = bytes(bytearray(s[pos+1:pos+l+1]))" % (var,),
+                "pos += l + 1"]
+    # Variable length integer (with fast path for a single byte)
+    if t.signed:
+        neg_code = "%s = c - 0x80" % (var,)
+        mask_code = "%s = v" % (var,)
+    else:
+        neg_code = "%s = c + 0xffffff80" % (var,)
+        mask_code = "%s = v & 0xffffffff" % (var,)
+    return ["c = s[pos]",
+            "pos += 1",
+            "if c & 0x80:",
+            "    v = c & 0x7f",
+            "    if (c & 0x60) == 0x60:",
+            "        v |= -0x20",
+            "    while c & 0x80:",
+            "        c = s[pos]",
+            "        pos += 1",
+            "        v = (v<<7) | (c & 0x7f)",
+            "    " + mask_code,
+            "elif c >= 0x60:",
+            "    " + neg_code,
+            "else:",
+            "    %s = c" % (var,)]
+
+# Build functions that decode all the parameters of a message.  Returns
+# a function producing a dictionary and a function producing a tuple.
+def compile_parsers(name, param_names):
+    namespace = {}
+    code = []
+    var_names = []
+    for i, (pname, t) in enumerate(param_names):
+        var = "v%d" % (i,)
+        var_names.append(var)
+        code.extend(gen_parse_code(t, var, namespace))
+    dict_items = ", ".join(["%s: %s" % (repr(pname), var)
+                            for (pname, t), var in zip(param_names,
+                                                       var_names)])
+    tuple_items = "".join([var + "," for var in var_names])
+    body = ["    " + line for line in ["pos += 1"] + code]
+    src = "\n".join(
+        ["def parse(s, pos):"] + body
+        + ["    return {%s}, pos" % (dict_items,),
+           "def parse_tuple(s, pos):"] + body
+        + ["    return (%s), pos" % (tuple_items,)]) + "\n"
+    exec(compile(src, "<msgproto %s>" % (name,), "exec"), namespace)
+    return namespace['parse'], namespace['parse_tuple']
+
 # Update the message format to be compatible with python's % operator
 def convert_msg_format(msgformat):
     for c in ['%u', '%i', '%hu', '%hi', '%c', '%.*s', '%*s']:
@@ -168,6 +228,12 @@ class MessageFormat:
         self.param_names = lookup_params(msgformat, enumerations)
         self.param_types = [t for name, t in self.param_names]
         self.name_to_type = dict(self.param_names)
+        self.field_names = tuple([name for name, t in self.param_names])
+        self.oid_index = None
+        if 'oid' in self.field_names:
+            self.oid_index = self.field_names.index('oid')
+        self.parse, self.parse_tuple = compile_parsers(self.name,
+                                                       self.param_names)
     def encode(self, params):
         out = []
         out.append(self.msgid)
@@ -180,13 +246,6 @@ class MessageFormat:
         for name, t in self.param_names:
             t.encode(out, params[name])
         return out
-    def parse(self, s, pos):
-        pos += 1
-        out = {}
-        for name, t in self.param_names:
-            v, pos = t.parse(s, pos)
-            out[name] = v
-        return out, pos
     def format_params(self, params):
         out = []
         for name, t in self.param_names:
@@ -198,6 +257,8 @@ class MessageFormat:
 
 class OutputFormat:
     name = '#output'
+    field_names = ('#msg',)
+    oid_index = None
     def __init__(self, msgid, msgformat):
         self.msgid = msgid
         self.msgformat = msgformat
@@ -213,15 +274,22 @@ class OutputFormat:
             out.append(v)
         outmsg = self.debugformat % tuple(out)
         return {'#msg': outmsg}, pos
+    def parse_tuple(self, s, pos):
+        params, pos = self.parse(s, pos)
+        return (params['#msg'],), pos
     def format_params(self, params):
         return "#output %s" % (params['#msg'],)
 
 class UnknownFormat:
     name = '#unknown'
+    field_names = ('#msgid', '#msg')
+    oid_index = None
     def parse(self, s, pos):
         msgid = s[pos]
         msg = bytes(bytearray(s))
         return {'#msgid': msgid, '#msg': msg}, len(s)-MESSAGE_TRAILER_SIZE
+    def parse_tuple(self, s, pos):
+        return (s[pos], bytes(bytearray(s))), len(s)-MESSAGE_TRAILER_SIZE
     def format_params(self, params):
         return "#unknown %s" % (repr(params['#msg']),)
 
@@ -289,6 +357,15 @@ class MessageParser:
             self._error("Extra data at end of message")
         params['#name'] = mid.name
         return params
+    def parse_tuple(self, s):
+        # Returns the message format and a tuple of the decoded
+        # parameters (in the order of the message format's field_names)
+        msgid = s[MESSAGE_HEADER_SIZE]
+        mid = self.messages_by_id.get(msgid, self.unknown)
+        values, pos = mid.parse_tuple(s, MESSAGE_HEADER_SIZE)
+        if pos != len(s)-MESSAGE_TRAILER_SIZE:
+            self._error("Extra data at end of message")
+        return mid, values
     def encode(self, seq, cmd):
         msglen = MESSAGE_MIN + len(cmd)
         seq = (seq & MESSAGE_SEQ_MASK) | MESSAGE_DEST
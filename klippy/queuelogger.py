@@ -5,18 +5,45 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, logging.handlers, threading, queue, time
 
+BG_QUEUE_SIZE = 50000
+
+# Message arguments of these types can be formatted later (in the
+# background thread) as their contents can not change
+IMMUTABLE_ARG_TYPES = (str, bytes, int, float, bool, type(None))
+
 # Class to forward all messages through a queue to a background thread
 class QueueHandler(logging.Handler):
     def __init__(self, queue):
         logging.Handler.__init__(self)
         self.queue = queue
+        self.drop_count = self.total_drop_count = 0
+    def _can_defer_format(self, record):
+        if record.exc_info or type(record.msg) is not str:
+            return False
+        args = record.args
+        if type(args) is not tuple:
+            return not args
+        for arg in args:
+            if type(arg) not in IMMUTABLE_ARG_TYPES:
+                return False
+        return True
     def emit(self, record):
         try:
-            self.format(record)
-            record.msg = record.message
-            record.args = None
-            record.exc_info = None
+            if not self._can_defer_format(record):
+                self.format(record)
+                record.msg = record.message
+                record.args = None
+                record.exc_info = None
+            if self.drop_count:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'msg': "queuelogger: dropped %d log messages",
+                    'args': (self.drop_count,), 'levelno': logging.WARNING,
+                    'levelname': 'WARNING'}))
+                self.drop_count = 0
             self.queue.put_nowait(record)
+        except queue.Full:
+            self.drop_count += 1
+            self.total_drop_count += 1
         except Exception:
             self.handleError(record)
 
@@ -25,7 +52,7 @@ class QueueListener(logging.handlers.TimedRotatingFileHandler):
     def __init__(self, filename):
         logging.handlers.TimedRotatingFileHandler.__init__(
             self, filename, when='midnight', backupCount=5)
-        self.bg_queue = queue.Queue()
+        self.bg_queue = queue.Queue(BG_QUEUE_SIZE)
         self.bg_thread = threading.Thread(target=self._bg_thread)
         self.bg_thread.start()
         self.rollover_info = {}
@@ -36,7 +63,7 @@ class QueueListener(logging.handlers.TimedRotatingFileHandler):
                 break
             self.handle(record)
     def stop(self):
-        self.bg_queue.put_nowait(None)
+        self.bg_queue.put(None)
         self.bg_thread.join()
     def set_rollover_info(self, name, info):
         if info is None:
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, queue
+import os, gc, select, math, time, logging, heapq, collections
 import greenlet
 import chelper, util
 
@@ -14,6 +14,7 @@ class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        self.heap_seq = None
 
 class ReactorCompletion:
     class sentinel: pass
@@ -102,11 +103,17 @@ class SelectReactor:
         self._check_gc = gc_checking
         self._last_gc_times = [0., 0., 0.]
         # Timers
-        self._timers = []
+        self._timer_heap = []
+        self._timer_seq = 0
+        self._timer_count = 0
+        self._timer_eventtime = 0.
         self._next_timer = self.NEVER
         # Callbacks
-        self._pipe_fds = None
-        self._async_queue = queue.Queue()
+        self._async_fds = None
+        self._async_queue = collections.deque()
+        self._async_pending = False
+        self._async_count = self._async_batches = self._async_max_batch = 0
+        self._async_latency = self._async_max_latency = 0.
         # File descriptors
         self._read_fds = []
         self._write_fds = []
@@ -117,21 +124,44 @@ class SelectReactor:
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
     # Timers
-    def update_timer(self, timer_handler, waketime):
+    #
+    # Pending timers are stored in a heap of (waketime, seq, timer)
+    # entries.  Changing a timer's waketime adds a new entry - the old
+    # entry is left in the heap and ignored when it is reached (an
+    # entry is only valid if its seq matches the timer's heap_seq).
+    def _schedule_timer(self, timer_handler, waketime):
         timer_handler.waketime = waketime
+        if timer_handler.heap_seq is None:
+            # Timer not registered
+            return
+        self._timer_seq = seq = self._timer_seq + 1
+        if waketime >= self.NEVER:
+            timer_handler.heap_seq = -1
+            return
+        timer_handler.heap_seq = seq
+        # Timers scheduled in the past are placed after any timers that
+        # were already due so that they can not starve those timers
+        heap = self._timer_heap
+        heapq.heappush(heap, (max(waketime, self._timer_eventtime),
+                              seq, timer_handler))
         self._next_timer = min(self._next_timer, waketime)
+        if len(heap) > 2 * self._timer_count + 64:
+            # Discard stale entries
+            heap[:] = [e for e in heap if e[1] == e[2].heap_seq]
+            heapq.heapify(heap)
+    def update_timer(self, timer_handler, waketime):
+        self._schedule_timer(timer_handler, waketime)
     def register_timer(self, callback, waketime=NEVER):
         timer_handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
-        self._next_timer = min(self._next_timer, waketime)
+        timer_handler.heap_seq = -1
+        self._timer_count += 1
+        self._schedule_timer(timer_handler, waketime)
         return timer_handler
     def unregister_timer(self, timer_handler):
+        if timer_handler.heap_seq is not None:
+            timer_handler.heap_seq = None
+            self._timer_count -= 1
         timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
-        timers.pop(timers.index(timer_handler))
-        self._timers = timers
     def _check_timers(self, eventtime, busy):
         if eventtime < self._next_timer:
             if busy:
@@ -150,17 +180,27 @@ class SelectReactor:
                     return 0.
             return min(1., max(.001, self._next_timer - eventtime))
         self._next_timer = self.NEVER
+        self._timer_eventtime = eventtime
+        # Only run timers scheduled before this check (a timer that is
+        # rescheduled to a time in the past runs on the next check)
+        last_seq = self._timer_seq
+        heap = self._timer_heap
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            waketime = t.waketime
-            if eventtime >= waketime:
-                t.waketime = self.NEVER
-                t.waketime = waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._next_timer = min(self._next_timer, waketime)
+        while heap:
+            waketime, seq, t = heap[0]
+            if waketime > eventtime or seq > last_seq:
+                break
+            heapq.heappop(heap)
+            if seq != t.heap_seq:
+                continue
+            t.heap_seq = -1
+            t.waketime = self.NEVER
+            self._schedule_timer(t, t.callback(eventtime))
+            if g_dispatch is not self._g_dispatch:
+                self._end_greenlet(g_dispatch)
+                return 0.
+        if heap:
+            self._next_timer = min(self._next_timer, heap[0][0])
         return 0.
     # Callbacks and Completions
     def completion(self):
@@ -169,35 +209,77 @@ class SelectReactor:
         rcb = ReactorCallback(self, callback, waketime)
         return rcb.completion
     # Asynchronous (from another thread) callbacks and completions
-    def register_async_callback(self, callback, waketime=NOW):
-        self._async_queue.put_nowait(
-            (ReactorCallback, (self, callback, waketime)))
+    #
+    # Requests are added to a deque and the main thread is only woken
+    # (via an eventfd or pipe) if it has not already been signaled
+    # since it last emptied the deque.
+    def _async_notify(self, func, args):
+        self._async_queue.append((self.monotonic(), func, args))
+        if not self._async_pending:
+            self._async_pending = True
+            self._async_wake()
+    def _async_wake(self):
+        async_fds = self._async_fds
+        if async_fds is None:
+            return
         try:
-            os.write(self._pipe_fds[1], b'.')
+            if async_fds[0] == async_fds[1]:
+                os.eventfd_write(async_fds[1], 1)
+            else:
+                os.write(async_fds[1], b'.')
         except os.error:
             pass
+    def register_async_callback(self, callback, waketime=NOW):
+        self._async_notify(ReactorCallback, (self, callback, waketime))
     def async_complete(self, completion, result):
-        self._async_queue.put_nowait((completion.complete, (result,)))
-        try:
-            os.write(self._pipe_fds[1], b'.')
-        except os.error:
-            pass
-    def _got_pipe_signal(self, eventtime):
+        self._async_notify(completion.complete, (result,))
+    def _got_async_signal(self, eventtime):
         try:
-            os.read(self._pipe_fds[0], 4096)
+            os.read(self._async_fds[0], 4096)
         except os.error:
             pass
-        while 1:
-            try:
-                func, args = self._async_queue.get_nowait()
-            except queue.Empty:
-                break
+        self._async_pending = False
+        async_queue = self._async_queue
+        count = 0
+        while async_queue:
+            reqtime, func, args = async_queue.popleft()
+            latency = eventtime - reqtime
+            if latency > 0.:
+                self._async_latency += latency
+                if latency > self._async_max_latency:
+                    self._async_max_latency = latency
+            count += 1
             func(*args)
+        if count:
+            self._async_count += count
+            self._async_batches += 1
+            if count > self._async_max_batch:
+                self._async_max_batch = count
+    def get_async_stats(self):
+        # Report (and reset) the async callback batch and latency stats
+        count = self._async_count
+        if not count:
+            return ""
+        msg = "async_batch_avg=%.1f async_batch_max=%d" \
+              " async_latency_avg=%.6f async_latency_max=%.6f" % (
+                  count / float(self._async_batches), self._async_max_batch,
+                  self._async_latency / count, self._async_max_latency)
+        self._async_count = self._async_batches = self._async_max_batch = 0
+        self._async_latency = self._async_max_latency = 0.
+        return msg
     def _setup_async_callbacks(self):
-        self._pipe_fds = os.pipe()
-        util.set_nonblock(self._pipe_fds[0])
-        util.set_nonblock(self._pipe_fds[1])
-        self.register_fd(self._pipe_fds[0], self._got_pipe_signal)
+        try:
+            efd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self._async_fds = (efd, efd)
+        except (AttributeError, os.error):
+            self._async_fds = os.pipe()
+            util.set_nonblock(self._async_fds[0])
+            util.set_nonblock(self._async_fds[1])
+        self.register_fd(self._async_fds[0], self._got_async_signal)
+        self._async_pending = False
+        if self._async_queue:
+            self._async_pending = True
+            self._async_wake()
     # Greenlets
     def _sys_pause(self, waketime):
         # Pause using system sleep for when reactor not running
@@ -284,7 +366,7 @@ class SelectReactor:
                     break
         self._g_dispatch = None
     def run(self):
-        if self._pipe_fds is None:
+        if self._async_fds is None:
             self._setup_async_callbacks()
         self._process = True
         g_next = ReactorGreenlet(run=self._dispatch_loop)
@@ -301,10 +383,11 @@ class SelectReactor:
             except:
                 logging.exception("reactor finalize greenlet terminate")
         self._all_greenlets = []
-        if self._pipe_fds is not None:
-            os.close(self._pipe_fds[0])
-            os.close(self._pipe_fds[1])
-            self._pipe_fds = None
+        if self._async_fds is not None:
+            os.close(self._async_fds[0])
+            if self._async_fds[1] != self._async_fds[0]:
+                os.close(self._async_fds[1])
+            self._async_fds = None
 
 class PollReactor(SelectReactor):
     def __init__(self, gc_checking=False):
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading, os
+import logging, threading, os, time
 import serial
 
 import msgproto, chelper, util
@@ -26,8 +26,12 @@ class SerialReader:
         # Threading
         self.lock = threading.Lock()
         self.background_thread = None
-        # Message handlers
+        # Message handlers (the handler table is replaced, never
+        # modified, so the background thread can use it without a lock)
         self.handlers = {}
+        self.handler_stats = {}
+        self.default_handler = (self.handle_default, False,
+                                self._get_handler_stats('#default'))
         self.register_response(self._handle_unknown_init, '#unknown')
         self.register_response(self.handle_output, '#output')
         # Sent message notification tracking
@@ -35,6 +39,7 @@ class SerialReader:
         self.pending_notifications = {}
     def _bg_thread(self):
         response = self.ffi_main.new('struct pull_queue_message *')
+        perf_counter = time.perf_counter
         while 1:
             self.ffi_lib.serialqueue_pull(self.serialqueue, response)
             count = response.len
@@ -46,14 +51,25 @@ class SerialReader:
                 completion = self.pending_notifications.pop(response.notify_id)
                 self.reactor.async_complete(completion, params)
                 continue
-            params = self.msgparser.parse(response.msg[0:count])
-            params['#sent_time'] = response.sent_time
-            params['#receive_time'] = response.receive_time
-            hdl = (params['#name'], params.get('oid'))
             try:
-                with self.lock:
-                    hdl = self.handlers.get(hdl, self.handle_default)
+                start_time = perf_counter()
+                s = bytearray(self.ffi_main.buffer(response.msg, count))
+                mid, values = self.msgparser.parse_tuple(s)
+                oid = None
+                if mid.oid_index is not None:
+                    oid = values[mid.oid_index]
+                hdl, as_tuple, hstats = self.handlers.get(
+                    (mid.name, oid), self.default_handler)
+                if as_tuple:
+                    hdl(values + (response.sent_time, response.receive_time))
+                else:
+                    params = dict(zip(mid.field_names, values))
+                    params['#name'] = mid.name
+                    params['#sent_time'] = response.sent_time
+                    params['#receive_time'] = response.receive_time
                     hdl(params)
+                hstats[0] += 1
+                hstats[1] += perf_counter() - start_time
             except:
                 logging.exception("%sException in serial callback",
                                   self.warn_prefix)
@@ -221,7 +237,14 @@ class SerialReader:
             return ""
         self.ffi_lib.serialqueue_get_stats(self.serialqueue,
                                            self.stats_buf, len(self.stats_buf))
-        return str(self.ffi_main.string(self.stats_buf).decode())
+        out = [str(self.ffi_main.string(self.stats_buf).decode())]
+        # Number of responses and cumulative processing time per handler
+        for name, (count, total_time) in sorted(self.handler_stats.items()):
+            if count:
+                name = name.lstrip('#')
+                out.append("recv_%s=%d recv_%s_time=%.3f" % (
+                    name, count, name, total_time))
+        return " ".join(out)
     def get_reactor(self):
         return self.reactor
     def get_msgparser(self):
@@ -231,12 +254,23 @@ class SerialReader:
     def get_default_command_queue(self):
         return self.default_cmd_queue
     # Serial response callbacks
-    def register_response(self, callback, name, oid=None):
+    def _get_handler_stats(self, name):
+        hstats = self.handler_stats.get(name)
+        if hstats is None:
+            hstats = self.handler_stats[name] = [0, 0.]
+        return hstats
+    def register_response(self, callback, name, oid=None, as_tuple=False):
+        # If as_tuple is set, the callback is passed a tuple of the
+        # message parameters (in message format order) followed by the
+        # sent and receive times instead of a dictionary
         with self.lock:
+            handlers = dict(self.handlers)
             if callback is None:
-                del self.handlers[name, oid]
+                del handlers[name, oid]
             else:
-                self.handlers[name, oid] = callback
+                handlers[name, oid] = (callback, as_tuple,
+                                       self._get_handler_stats(name))
+            self.handlers = handlers
     # Command sending
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
         self.ffi_lib.serialqueue_send(self.serialqueue, cmd_queue,
@@ -252,6 +286,12 @@ class SerialReader:
         if params is None:
             self._error("Serial connection closed")
         return params
+    def send_all(self, cmds):
+        # Queue a list of encoded commands (the serialqueue limits the
+        # amount of data in flight to the mcu's receive window)
+        cmd_queue = self.default_cmd_queue
+        for cmd in cmds:
+            self.raw_send(cmd, 0, 0, cmd_queue)
     def send(self, msg, minclock=0, reqclock=0):
         cmd = self.msgparser.create_command(msg)
         self.raw_send(cmd, minclock, reqclock, self.default_cmd_queue)
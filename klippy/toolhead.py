@@ -12,6 +12,12 @@ import mcu, chelper, kinematics.extruder
 
 # Class to track each move request
 class Move:
+    __slots__ = ('toolhead', 'start_pos', 'end_pos', 'accel',
+                 'junction_deviation', 'timing_callbacks', 'is_kinematic_move',
+                 'axes_d', 'move_d', 'axes_r', 'min_move_t', 'max_start_v2',
+                 'max_cruise_v2', 'delta_v2', 'max_smoothed_v2',
+                 'smooth_delta_v2', 'start_v', 'cruise_v', 'end_v',
+                 'accel_t', 'cruise_t', 'decel_t')
     def __init__(self, toolhead, start_pos, end_pos, speed):
         self.toolhead = toolhead
         self.start_pos = tuple(start_pos)
@@ -115,6 +121,10 @@ class MoveQueue:
         self.toolhead = toolhead
         self.queue = []
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        # Buffers (indexed by queue position) for moves with delayed
+        # junction calculation
+        self.delayed_start_v2 = []
+        self.delayed_end_v2 = []
     def reset(self):
         del self.queue[:]
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
@@ -131,8 +141,15 @@ class MoveQueue:
         flush_count = len(queue)
         # Traverse queue from last to first move and determine maximum
         # junction speed assuming the robot comes to a complete stop
-        # after the last move.
-        delayed = []
+        # after the last move.  Delayed moves are always a contiguous
+        # range of the queue starting just after the current move.
+        delayed_start_v2 = self.delayed_start_v2
+        delayed_end_v2 = self.delayed_end_v2
+        if len(delayed_start_v2) < flush_count:
+            grow = [0.] * (flush_count - len(delayed_start_v2))
+            delayed_start_v2.extend(grow)
+            delayed_end_v2.extend(grow)
+        delayed = 0
         next_end_v2 = next_smoothed_v2 = peak_cruise_v2 = 0.
         for i in range(flush_count-1, -1, -1):
             move = queue[i]
@@ -155,11 +172,13 @@ class MoveQueue:
                         # Propagate peak_cruise_v2 to any delayed moves
                         if not update_flush_count and i < flush_count:
                             mc_v2 = peak_cruise_v2
-                            for m, ms_v2, me_v2 in reversed(delayed):
+                            for j in range(i + 1, i + 1 + delayed):
+                                ms_v2 = delayed_start_v2[j]
+                                me_v2 = delayed_end_v2[j]
                                 mc_v2 = min(mc_v2, ms_v2)
-                                m.set_junction(min(ms_v2, mc_v2), mc_v2
-                                               , min(me_v2, mc_v2))
-                        del delayed[:]
+                                queue[j].set_junction(min(ms_v2, mc_v2), mc_v2
+                                                      , min(me_v2, mc_v2))
+                        delayed = 0
                 if not update_flush_count and i < flush_count:
                     cruise_v2 = min((start_v2 + reachable_start_v2) * .5
                                     , move.max_cruise_v2, peak_cruise_v2)
@@ -167,7 +186,9 @@ class MoveQueue:
                                       , min(next_end_v2, cruise_v2))
             else:
                 # Delay calculating this move until peak_cruise_v2 is known
-                delayed.append((move, start_v2, next_end_v2))
+                delayed_start_v2[i] = start_v2
+                delayed_end_v2[i] = next_end_v2
+                delayed += 1
             next_end_v2 = start_v2
             next_smoothed_v2 = smoothed_v2
         if update_flush_count or not flush_count:
@@ -7,6 +7,8 @@ import logging, socket, os, sys, errno, json, collections
 import gcode
 
 REQUEST_LOG_SIZE = 20
+SEND_HIGH_WATER = 65536
+SEND_MAX_BUFFERS = 64
 
 # Json decodes strings as unicode types in Python 2.x.  This doesn't
 # play well with some parts of Klipper (particuarly displays), so we
@@ -26,6 +28,19 @@ if sys.version_info.major < 3:
                     for k, v in data.items()}
         return data
 
+# Allow array types (eg, numpy arrays of sensor samples) to be sent
+def json_encode_default(obj):
+    tolist = getattr(obj, 'tolist', None)
+    if tolist is None:
+        raise TypeError("Object of type %s is not JSON serializable"
+                        % (type(obj).__name__,))
+    return tolist()
+
+def encode_message(data):
+    jmsg = json.dumps(data, separators=(',', ':'),
+                      default=json_encode_default)
+    return memoryview(jmsg.encode() + b"\x03")
+
 class WebRequestError(gcode.CommandError):
     def __init__(self, message,):
         Exception.__init__(self, message)
@@ -108,6 +123,7 @@ class ServerSocket:
         self.reactor = printer.get_reactor()
         self.sock = self.fd_handle = None
         self.clients = {}
+        self.coalesce_count = self.drop_count = 0
         start_args = printer.get_start_args()
         server_address = start_args.get('apiserver')
         is_fileinput = (start_args.get('debuginput') is not None)
@@ -170,7 +186,11 @@ class ServerSocket:
                 if client.blocking_count < 0:
                     logging.info("Closing unresponsive client %s", client.uid)
                     client.close()
-        return False, ""
+        if not self.clients and not self.coalesce_count:
+            return False, ""
+        send_size = sum([c.send_size for c in self.clients.values()])
+        return False, "webhooks: send_queue=%d coalesced=%d dropped=%d" % (
+            send_size, self.coalesce_count, self.drop_count)
 
 class ClientConnection:
     def __init__(self, server, sock):
@@ -182,7 +202,11 @@ class ClientConnection:
         self.sock = sock
         self.fd_handle = self.reactor.register_fd(
             self.sock.fileno(), self.process_received, self._do_send)
-        self.partial_data = self.send_buffer = b""
+        self.partial_data = b""
+        self.send_queue = collections.deque()
+        self.send_size = 0
+        self.send_high_water = SEND_HIGH_WATER
+        self.pending_status = None
         self.is_blocking = False
         self.blocking_count = 0
         self.set_client_info("?", "New connection")
@@ -217,6 +241,9 @@ class ClientConnection:
             self.sock.close()
         except socket.error:
             pass
+        self.send_queue.clear()
+        self.send_size = 0
+        self.pending_status = None
         self.server.pop_client(self.uid)
 
     def is_closed(self):
@@ -267,24 +294,101 @@ class ClientConnection:
             return
         self.send(result)
 
-    def send(self, data):
-        jmsg = json.dumps(data, separators=(',', ':'))
-        self.send_buffer += jmsg.encode() + b"\x03"
+    def set_send_high_water(self, send_high_water):
+        self.send_high_water = send_high_water
+
+    def _queue_message(self, msg):
+        self.send_queue.append(msg)
+        self.send_size += len(msg)
+
+    def _queue_pending_status(self):
+        template, eventtime, status = self.pending_status
+        self.pending_status = None
+        tmp = dict(template)
+        tmp['params'] = {'eventtime': eventtime, 'status': status}
+        self._queue_message(encode_message(tmp))
+
+    def send_encoded(self, msg):
+        if self.fd_handle is None:
+            return
+        if self.pending_status is not None:
+            self._queue_pending_status()
+        self._queue_message(msg)
         if not self.is_blocking:
             self._do_send()
 
+    def send(self, data):
+        self.send_encoded(encode_message(data))
+
+    def send_status(self, template, eventtime, status, msg=None):
+        # Send a subscription update (msg may contain the already
+        # encoded update).  If the client is not keeping up, the update
+        # is merged into a single pending update instead.
+        if self.pending_status is None:
+            if self.send_size <= self.send_high_water:
+                if msg is None:
+                    tmp = dict(template)
+                    tmp['params'] = {'eventtime': eventtime, 'status': status}
+                    msg = encode_message(tmp)
+                self.send_encoded(msg)
+                return
+            if self.fd_handle is None:
+                return
+            self.pending_status = (template, eventtime, {
+                obj_name: dict(res) for obj_name, res in status.items()})
+            return
+        pstatus = self.pending_status[2]
+        drop_count = 0
+        for obj_name, res in status.items():
+            pres = pstatus.setdefault(obj_name, {})
+            drop_count += len([ri for ri in res if ri in pres])
+            pres.update(res)
+        self.pending_status = (template, eventtime, pstatus)
+        self.server.coalesce_count += 1
+        self.server.drop_count += drop_count
+
+    def _send_data(self):
+        # Write queued messages to the socket (without copying them).
+        # Returns True if all the data offered to the socket was sent.
+        send_queue = self.send_queue
+        if len(send_queue) > 1 and hasattr(self.sock, 'sendmsg'):
+            bufs = [send_queue[i] for i in range(
+                min(len(send_queue), SEND_MAX_BUFFERS))]
+        else:
+            bufs = [send_queue[0]]
+        if len(bufs) > 1:
+            sent = self.sock.sendmsg(bufs)
+        else:
+            sent = self.sock.send(bufs[0])
+        self.send_size -= sent
+        for msg in bufs:
+            if sent < len(msg):
+                send_queue[0] = msg[sent:]
+                return False
+            sent -= len(msg)
+            send_queue.popleft()
+        return True
+
     def _do_send(self, eventtime=None):
         if self.fd_handle is None:
             return
-        try:
-            sent = self.sock.send(self.send_buffer)
-        except socket.error as e:
-            if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
-                logging.info("webhooks: socket write error %d" % (self.uid,))
-                self.close()
-                return
-            sent = 0
-        if sent < len(self.send_buffer):
+        send_queue = self.send_queue
+        while send_queue:
+            try:
+                is_complete = self._send_data()
+            except socket.error as e:
+                if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    logging.info("webhooks: socket write error %d"
+                                 % (self.uid,))
+                    self.close()
+                    return
+                is_complete = False
+            if (self.pending_status is not None
+                and self.send_size <= self.send_high_water):
+                self._queue_pending_status()
+            if not is_complete:
+                break
+        if send_queue:
             if not self.is_blocking:
                 self.reactor.set_fd_wake(self.fd_handle, False, True)
                 self.is_blocking = True
@@ -292,7 +396,6 @@ class ClientConnection:
         elif self.is_blocking:
             self.reactor.set_fd_wake(self.fd_handle, True, False)
             self.is_blocking = False
-        self.send_buffer = self.send_buffer[sent:]
 
 class WebHooks:
     def __init__(self, printer):
@@ -345,6 +448,12 @@ class WebHooks:
         client_info = web_request.get_dict('client_info', None)
         if client_info is not None:
             web_request.get_client_connection().set_client_info(client_info)
+        send_high_water = web_request.get_int('send_high_water', None)
+        if send_high_water is not None:
+            if send_high_water < 0:
+                raise web_request.error("Invalid send_high_water")
+            cconn = web_request.get_client_connection()
+            cconn.set_send_high_water(send_high_water)
         state_message, state = self.printer.get_state_message()
         src_path = os.path.dirname(__file__)
         klipper_path = os.path.normpath(os.path.join(src_path, ".."))
@@ -452,6 +561,9 @@ class QueryStatusHelper:
         self.pending_queries = []
         self.query_timer = None
         self.last_query = {}
+        start_args = printer.get_start_args()
+        self.refresh_time = start_args.get('api_refresh_time',
+                                           SUBSCRIPTION_REFRESH_TIME)
         # Register webhooks
         webhooks = printer.lookup_object('webhooks')
         webhooks.register_endpoint("objects/list", self._handle_list)
@@ -461,14 +573,19 @@ class QueryStatusHelper:
         objects = [n for n, o in self.printer.lookup_objects()
                    if hasattr(o, 'get_status')]
         web_request.send({'objects': objects})
+    def _get_subscription_key(self, subscription, template):
+        # Clients with identical keys receive identical updates
+        return json.dumps([subscription, template], sort_keys=True)
     def _do_query(self, eventtime):
         last_query = self.last_query
         query = self.last_query = {}
+        changes = {}
+        encoded = {}
         msglist = self.pending_queries
         self.pending_queries = []
         msglist.extend(self.clients.values())
         # Generate get_status() info for each client
-        for cconn, subscription, send_func, template in msglist:
+        for cconn, subscription, send_func, template, sub_key in msglist:
             is_query = cconn is None
             if not is_query and cconn.is_closed():
                 del self.clients[cconn]
@@ -487,26 +604,47 @@ class QueryStatusHelper:
                     req_items = list(res.keys())
                     if req_items:
                         subscription[obj_name] = req_items
-                lres = last_query.get(obj_name, {})
-                cres = {}
-                for ri in req_items:
-                    rd = res.get(ri, None)
-                    if is_query or rd != lres.get(ri):
-                        cres[ri] = rd
-                if cres or is_query:
+                        sub_key = None
+                if is_query:
+                    cquery[obj_name] = {ri: res.get(ri, None)
+                                        for ri in req_items}
+                    continue
+                # Find the fields that changed since the last update
+                ochanges = changes.get(obj_name)
+                if ochanges is None:
+                    lres = last_query.get(obj_name, {})
+                    ochanges = changes[obj_name] = {
+                        ri: rd for ri, rd in res.items() if rd != lres.get(ri)}
+                    for ri, lrd in lres.items():
+                        if ri not in res and lrd is not None:
+                            ochanges[ri] = None
+                cres = {ri: ochanges[ri] for ri in req_items if ri in ochanges}
+                if cres:
                     cquery[obj_name] = cres
             # Send data
-            if cquery or is_query:
+            if is_query:
                 tmp = dict(template)
                 tmp['params'] = {'eventtime': eventtime, 'status': cquery}
                 send_func(tmp)
+                continue
+            if sub_key is None:
+                sub_key = self._get_subscription_key(subscription, template)
+                self.clients[cconn] = (cconn, subscription, send_func,
+                                       template, sub_key)
+            if cquery:
+                msg = encoded.get(sub_key)
+                if msg is None:
+                    tmp = dict(template)
+                    tmp['params'] = {'eventtime': eventtime, 'status': cquery}
+                    msg = encoded[sub_key] = encode_message(tmp)
+                cconn.send_status(template, eventtime, cquery, msg)
         if not query:
             # Unregister timer if there are no longer any subscriptions
             reactor = self.printer.get_reactor()
             reactor.unregister_timer(self.query_timer)
             self.query_timer = None
             return reactor.NEVER
-        return eventtime + SUBSCRIPTION_REFRESH_TIME
+        return eventtime + self.refresh_time
     def _handle_query(self, web_request, is_subscribe=False):
         objects = web_request.get_dict('objects')
         # Validate subscription format
@@ -524,7 +662,8 @@ class QueryStatusHelper:
             del self.clients[cconn]
         reactor = self.printer.get_reactor()
         complete = reactor.completion()
-        self.pending_queries.append((None, objects, complete.complete, {}))
+        self.pending_queries.append((None, objects, complete.complete, {},
+                                     None))
         # Start timer if needed
         if self.query_timer is None:
             qt = reactor.register_timer(self._do_query, reactor.NOW)
@@ -533,7 +672,9 @@ class QueryStatusHelper:
         msg = complete.wait()
         web_request.send(msg['params'])
         if is_subscribe:
-            self.clients[cconn] = (cconn, objects, cconn.send, template)
+            sub_key = self._get_subscription_key(objects, template)
+            self.clients[cconn] = (cconn, objects, cconn.send, template,
+                                   sub_key)
     def _handle_subscribe(self, web_request):
         self._handle_query(web_request, is_subscribe=True)
 
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Benchmark the encoding of motion_report dump messages
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, time, random
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             'motan'))
+import chelper, webhooks, readlog
+from extras import motion_report
+
+# Generate (cdata, count) chunks in the layout returned by the chelper
+# extraction functions (newest entry first within each chunk)
+def gen_chunks(ctype, count, fill_func):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    chunks = []
+    pos = 0
+    while pos < count:
+        data = ffi_main.new('%s[128]' % (ctype,))
+        cnt = min(len(data), count - pos)
+        for i in range(cnt):
+            fill_func(data[cnt - 1 - i], pos + i)
+        chunks.append((data, cnt))
+        pos += cnt
+    return chunks
+
+def fill_step(s, i):
+    if random.random() < .9:
+        s.interval, s.step_count, s.add = 10000, 1000, 0
+    else:
+        s.interval = random.randrange(5000, 30000)
+        s.step_count = random.randrange(1, 10)
+        s.add = random.randrange(-10000, 10000)
+
+def fill_move(m, i):
+    m.print_time = i * .01
+    m.move_t = random.random() * .01
+    m.start_v, m.accel = random.random() * 300., random.random() * 5000.
+    m.start_x, m.start_y, m.start_z = [random.random() * 300.
+                                       for j in range(3)]
+    m.x_r, m.y_r, m.z_r = random.random(), random.random(), 0.
+
+# Build the message "data" list as the DumpStepper/DumpTrapQ would
+def stepper_msg(chunks):
+    data = [d[i] for d, cnt in chunks for i in range(cnt-1, -1, -1)]
+    return {'data': [(s.interval, s.step_count, s.add) for s in data]}
+
+def trapq_msg(chunks):
+    data = [d[i] for d, cnt in chunks for i in range(cnt-1, -1, -1)]
+    return {'data': [(m.print_time, m.move_t, m.start_v, m.accel,
+                      (m.start_x, m.start_y, m.start_z),
+                      (m.x_r, m.y_r, m.z_r)) for m in data]}
+
+def run_bench(func, repeat):
+    best = None
+    for i in range(repeat):
+        start_time = time.perf_counter()
+        res = func()
+        t = time.perf_counter() - start_time
+        best = t if best is None else min(best, t)
+    return best, res
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count", default=2000,
+                    help="number of entries per message")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=20,
+                    help="number of benchmark runs")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    random.seed(0)
+    tests = [
+        ("stepq", gen_chunks('struct pull_history_steps', options.count,
+                             fill_step), stepper_msg,
+         motion_report.encode_stepper_binary, readlog.decode_stepq_binary),
+        ("trapq", gen_chunks('struct pull_move', options.count, fill_move),
+         trapq_msg, motion_report.encode_trapq_binary,
+         readlog.decode_trapq_binary)]
+    for name, chunks, msg_func, encode, decode in tests:
+        msg = msg_func(chunks)
+        # Check that the encoding decodes to the original data
+        params = encode(msg, chunks)
+        decode(params)
+        if params['data'] != msg['data']:
+            sys.stderr.write("Mismatch decoding %s\n" % (name,))
+            sys.exit(1)
+        jtime, jres = run_bench(
+            lambda: webhooks.encode_message({'params': msg}), options.repeat)
+        btime, bres = run_bench(
+            lambda: webhooks.encode_message(
+                {'params': encode(msg, chunks)}), options.repeat)
+        print("%s (%d entries): json %.3fms (%d bytes)"
+              ", binary %.3fms (%d bytes), %.1fx" % (
+                  name, options.count, jtime * 1000., len(jres),
+                  btime * 1000., len(bres), jtime / btime))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Benchmark the toolhead look-ahead queue with a recorded move stream
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, time, gc, math
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import toolhead
+
+
+######################################################################
+# Move stream loading
+######################################################################
+
+# Extract the G0/G1 moves from a g-code file as absolute positions
+def parse_gcode(filename):
+    moves = []
+    pos = [0., 0., 0., 0.]
+    speed = 25.
+    absolute_coord = absolute_extrude = True
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.split(';', 1)[0].strip().upper()
+            parts = line.split()
+            if not parts:
+                continue
+            cmd = parts[0]
+            params = {}
+            for p in parts[1:]:
+                try:
+                    params[p[0]] = float(p[1:])
+                except ValueError:
+                    pass
+            if cmd == 'G90':
+                absolute_coord = absolute_extrude = True
+            elif cmd == 'G91':
+                absolute_coord = absolute_extrude = False
+            elif cmd == 'M82':
+                absolute_extrude = True
+            elif cmd == 'M83':
+                absolute_extrude = False
+            elif cmd == 'G92':
+                for i, axis in enumerate('XYZE'):
+                    if axis in params:
+                        pos[i] = params[axis]
+            elif cmd in ('G0', 'G1'):
+                newpos = list(pos)
+                for i, axis in enumerate('XYZ'):
+                    if axis in params:
+                        if absolute_coord:
+                            newpos[i] = params[axis]
+                        else:
+                            newpos[i] += params[axis]
+                if 'E' in params:
+                    if absolute_extrude:
+                        newpos[3] = params['E']
+                    else:
+                        newpos[3] += params['E']
+                if 'F' in params:
+                    speed = params['F'] / 60.
+                moves.append((tuple(newpos), speed))
+                pos = newpos
+    return moves
+
+# Generate a synthetic stream of short moves around a circle
+def gen_moves(count):
+    moves = []
+    for i in range(count):
+        angle = i * 2. * math.pi / 360.
+        pos = (100. + 50. * math.cos(angle), 100. + 50. * math.sin(angle),
+               .2 * (i // 360), i * .01)
+        moves.append((pos, 150.))
+    return moves
+
+
+######################################################################
+# Simulated toolhead
+######################################################################
+
+class DummyExtruder:
+    def calc_junction(self, prev_move, move):
+        return move.max_cruise_v2
+
+class BenchToolHead:
+    def __init__(self, max_velocity, max_accel, square_corner_velocity):
+        self.max_velocity = max_velocity
+        self.max_accel = max_accel
+        self.max_accel_to_decel = max_accel * .5
+        scv2 = square_corner_velocity**2
+        self.junction_deviation = scv2 * (math.sqrt(2.) - 1.) / max_accel
+        self.extruder = DummyExtruder()
+        self.move_queue = toolhead.MoveQueue(self)
+        self.move_queue.set_flush_time(2.)
+        self.commanded_pos = [0., 0., 0., 0.]
+        self.move_count = 0
+        self.move_time = 0.
+    def _process_moves(self, moves):
+        for move in moves:
+            self.move_time += move.accel_t + move.cruise_t + move.decel_t
+        self.move_count += len(moves)
+    def move(self, newpos, speed):
+        move = toolhead.Move(self, self.commanded_pos, newpos, speed)
+        if not move.move_d:
+            return
+        self.commanded_pos[:] = move.end_pos
+        self.move_queue.add_move(move)
+
+def run_bench(moves, options):
+    th = BenchToolHead(options.velocity, options.accel, options.scv)
+    gc.collect()
+    start_time = time.perf_counter()
+    for newpos, speed in moves:
+        th.move(newpos, speed)
+    th.move_queue.flush()
+    total_time = time.perf_counter() - start_time
+    return th, total_time
+
+def main():
+    usage = "%prog [options] [<gcode file>]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count", default=100000,
+                    help="number of synthetic moves (if no file given)")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of benchmark runs")
+    opts.add_option("--velocity", type="float", dest="velocity", default=300.,
+                    help="max_velocity of the simulated toolhead")
+    opts.add_option("--accel", type="float", dest="accel", default=3000.,
+                    help="max_accel of the simulated toolhead")
+    opts.add_option("--scv", type="float", dest="scv", default=5.,
+                    help="square_corner_velocity of the simulated toolhead")
+    options, args = opts.parse_args()
+    if len(args) > 1:
+        opts.error("Incorrect number of arguments")
+    if args:
+        moves = parse_gcode(args[0])
+    else:
+        moves = gen_moves(options.count)
+    best = None
+    for i in range(options.repeat):
+        th, total_time = run_bench(moves, options)
+        if best is None or total_time < best:
+            best = total_time
+        print("Run %d: %d moves in %.3fs (%.2fus/move, print time %.3fs)"
+              % (i, th.move_count, total_time,
+                 total_time * 1000000. / max(1, th.move_count), th.move_time))
+    print("Best: %.2fus/move" % (best * 1000000. / max(1, len(moves)),))
+
+if __name__ == '__main__':
+    main()
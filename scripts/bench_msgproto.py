@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Benchmark the decoding of mcu response messages
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, time, json, random
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import msgproto
+
+# Sample of high-rate responses (used when no data dictionary is given)
+SAMPLE_RESPONSES = {
+    "adxl345_data oid=%c sequence=%hu data=%*s": 80,
+    "analog_in_state oid=%c next_clock=%u value=%hu": 81,
+    "stats count=%u sum=%u sumsq=%u": 82,
+    "t5uid1_received data=%*s": 83,
+    "clock clock=%u": 84,
+    "trsync_state oid=%c can_trigger=%c trigger_reason=%c clock=%u": 85,
+}
+
+# Reference implementation that decodes one parameter at a time
+def parse_reference(msgparser, s):
+    msgid = s[msgproto.MESSAGE_HEADER_SIZE]
+    mid = msgparser.messages_by_id.get(msgid, msgparser.unknown)
+    if not hasattr(mid, 'param_names'):
+        return mid.parse(s, msgproto.MESSAGE_HEADER_SIZE)[0]
+    pos = msgproto.MESSAGE_HEADER_SIZE + 1
+    params = {}
+    for name, t in mid.param_names:
+        v, pos = t.parse(s, pos)
+        params[name] = v
+    params['#name'] = mid.name
+    return params
+
+def load_parser(dict_filename):
+    msgparser = msgproto.MessageParser()
+    if dict_filename is None:
+        data = {'responses': SAMPLE_RESPONSES, 'commands': {},
+                'version': 'bench', 'build_versions': ''}
+        msgparser.process_identify(json.dumps(data).encode(), decompress=False)
+    else:
+        with open(dict_filename, 'rb') as f:
+            msgparser.process_identify(f.read(), decompress=False)
+    return msgparser
+
+# Split a captured raw serial stream into messages
+def load_stream(msgparser, filename):
+    with open(filename, 'rb') as f:
+        data = bytearray(f.read())
+    msgs = []
+    while data:
+        l = msgparser.check_packet(data)
+        if l == 0:
+            break
+        if l < 0:
+            # Resync on the next sync byte
+            pos = data.find(bytearray([msgproto.MESSAGE_SYNC]))
+            del data[:pos+1 if pos >= 0 else len(data)]
+            continue
+        msgs.append(data[:l])
+        del data[:l]
+    return msgs
+
+def gen_value(t):
+    if t.is_dynamic_string:
+        return bytes(bytearray([random.randrange(256)
+                                for i in range(random.choice([0, 6, 30]))]))
+    if isinstance(t, msgproto.Enumeration):
+        return random.choice(list(t.enums.keys()))
+    if t.max_length <= 2:
+        return random.randrange(256)
+    if t.max_length <= 3:
+        return random.randrange(65536)
+    return random.randrange(1 << 32) >> random.randrange(32)
+
+# Generate a stream of random messages using the response formats
+def gen_stream(msgparser, count):
+    formats = [mp for mp in msgparser.messages_by_id.values()
+               if hasattr(mp, 'param_names') and mp.name != 'identify']
+    msgs = []
+    for i in range(count):
+        mp = random.choice(formats)
+        cmd = mp.encode([gen_value(t) for name, t in mp.param_names])
+        out = msgparser.encode(i, cmd)
+        msgs.append(bytearray(out[:-2] + out[-2] + out[-1:]))
+    return msgs
+
+def run_bench(func, msgs):
+    start_time = time.perf_counter()
+    for s in msgs:
+        func(s)
+    return time.perf_counter() - start_time
+
+def main():
+    usage = "%prog [options] [<data dictionary> [<raw stream>]]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count",
+                    default=200000, help="number of generated messages")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of benchmark runs")
+    options, args = opts.parse_args()
+    if len(args) > 2:
+        opts.error("Incorrect number of arguments")
+    random.seed(0)
+    msgparser = load_parser(args[0] if args else None)
+    if len(args) > 1:
+        msgs = load_stream(msgparser, args[1])
+    else:
+        msgs = gen_stream(msgparser, options.count)
+    if not msgs:
+        opts.error("No messages found")
+    # Check that all decoders agree
+    for s in msgs:
+        ref = parse_reference(msgparser, s)
+        mid, values = msgparser.parse_tuple(s)
+        if msgparser.parse(s) != ref or values != tuple(
+                [ref[name] for name in mid.field_names]):
+            sys.stderr.write("Mismatch decoding %s\n" % (repr(s),))
+            sys.exit(1)
+    tests = [("reference", lambda s: parse_reference(msgparser, s)),
+             ("compiled", msgparser.parse),
+             ("tuple", msgparser.parse_tuple)]
+    best = {}
+    for i in range(options.repeat):
+        for name, func in tests:
+            t = run_bench(func, msgs)
+            best[name] = min(best.get(name, t), t)
+    ref_time = best["reference"]
+    for name, func in tests:
+        print("%-10s %.3fs (%.2fus/msg, %.1fx)" % (
+            name, best[name], best[name] * 1000000. / len(msgs),
+            ref_time / best[name]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Benchmark the reactor timer dispatch cost versus the number of timers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import reactor
+
+# Reference implementation that scans a list of all timers on each check
+class ListTimerReactor(reactor.PollReactor):
+    def __init__(self):
+        reactor.PollReactor.__init__(self)
+        self._timers = []
+    def update_timer(self, timer_handler, waketime):
+        timer_handler.waketime = waketime
+        self._next_timer = min(self._next_timer, waketime)
+    def register_timer(self, callback, waketime=reactor._NEVER):
+        timer_handler = reactor.ReactorTimer(callback, waketime)
+        timers = list(self._timers)
+        timers.append(timer_handler)
+        self._timers = timers
+        self._next_timer = min(self._next_timer, waketime)
+        return timer_handler
+    def unregister_timer(self, timer_handler):
+        timer_handler.waketime = self.NEVER
+        timers = list(self._timers)
+        timers.pop(timers.index(timer_handler))
+        self._timers = timers
+    def _check_timers(self, eventtime, busy):
+        if eventtime < self._next_timer:
+            return 0.
+        self._next_timer = self.NEVER
+        for t in self._timers:
+            waketime = t.waketime
+            if eventtime >= waketime:
+                t.waketime = self.NEVER
+                t.waketime = waketime = t.callback(eventtime)
+            self._next_timer = min(self._next_timer, waketime)
+        return 0.
+
+# Simulate a reactor with a number of timers that run at different
+# intervals (like heater, fan, and display update timers).  Each check
+# advances the clock by one millisecond.
+def run_bench(r, count, checks):
+    callbacks = [0]
+    def make_timer(interval):
+        def callback(eventtime):
+            callbacks[0] += 1
+            return eventtime + interval
+        return callback
+    for i in range(count):
+        interval = [.1, .25, .5, 1., 5.][i % 5]
+        r.register_timer(make_timer(interval), i * .001 % interval)
+    # A timer that is frequently rescheduled (like a serial retransmit)
+    rescheduled = r.register_timer(make_timer(1.), r.NEVER)
+    start_time = time.perf_counter()
+    eventtime = 0.
+    for i in range(checks):
+        eventtime += .001
+        r.update_timer(rescheduled, eventtime + .005)
+        r._check_timers(eventtime, True)
+    total_time = time.perf_counter() - start_time
+    return total_time, callbacks[0]
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--checks", type="int", dest="checks",
+                    default=20000, help="number of timer checks per run")
+    opts.add_option("-c", "--counts", type="string", dest="counts",
+                    default="10,50,100,200,500,1000",
+                    help="comma separated list of timer counts")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    for count in [int(c) for c in options.counts.split(',')]:
+        ref_time, ref_calls = run_bench(ListTimerReactor(), count,
+                                        options.checks)
+        heap_time, heap_calls = run_bench(reactor.PollReactor(), count,
+                                          options.checks)
+        print("%5d timers: list %.2fus/check heap %.2fus/check (%.1fx)"
+              " callbacks %d/%d" % (
+                  count, ref_time * 1000000. / options.checks,
+                  heap_time * 1000000. / options.checks,
+                  ref_time / heap_time, ref_calls, heap_calls))
+
+if __name__ == '__main__':
+    main()
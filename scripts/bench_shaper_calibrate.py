@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Benchmark the input shaper auto-tuning calculations
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import importlib, optparse, os, sys, time
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+shaper_calibrate = importlib.import_module('.shaper_calibrate', 'extras')
+shaper_defs = importlib.import_module('.shaper_defs', 'extras')
+
+# Reference implementation of the max_accel search by bisection
+def find_shaper_max_accel_reference(helper, shaper):
+    func = lambda test_accel: helper._get_shaper_smoothing(
+            shaper, test_accel) <= .12
+    left = right = 1.
+    while not func(left):
+        right = left
+        left *= .5
+    if right == left:
+        while func(right):
+            right *= 2.
+    while right - left > 1e-8:
+        middle = (left + right) * .5
+        if func(middle):
+            left = middle
+        else:
+            right = middle
+    return left
+
+# Reference implementation of the per-frequency shaper fitting loop
+def fit_shaper_reference(helper, shaper_cfg, calibration_data, max_smoothing):
+    test_freqs = np.arange(shaper_cfg.min_freq,
+                           shaper_calibrate.MAX_SHAPER_FREQ, .2)
+    freq_bins = calibration_data.freq_bins
+    psd = calibration_data.psd_sum[freq_bins <= shaper_calibrate.MAX_FREQ]
+    freq_bins = freq_bins[freq_bins <= shaper_calibrate.MAX_FREQ]
+    best_res = None
+    results = []
+    for test_freq in test_freqs[::-1]:
+        shaper_vibrations = 0.
+        shaper_vals = np.zeros(shape=freq_bins.shape)
+        shaper = shaper_cfg.init_func(
+                test_freq, shaper_defs.DEFAULT_DAMPING_RATIO)
+        shaper_smoothing = helper._get_shaper_smoothing(shaper)
+        if max_smoothing and shaper_smoothing > max_smoothing and best_res:
+            return best_res
+        for dr in shaper_calibrate.TEST_DAMPING_RATIOS:
+            vibrations, vals = helper._estimate_remaining_vibrations(
+                    shaper, dr, freq_bins, psd)
+            shaper_vals = np.maximum(shaper_vals, vals)
+            if vibrations > shaper_vibrations:
+                shaper_vibrations = vibrations
+        max_accel = find_shaper_max_accel_reference(helper, shaper)
+        shaper_score = shaper_smoothing * (shaper_vibrations**1.5 +
+                                           shaper_vibrations * .2 + .01)
+        results.append(shaper_calibrate.CalibrationResult(
+            name=shaper_cfg.name, freq=test_freq, vals=shaper_vals,
+            vibrs=shaper_vibrations, smoothing=shaper_smoothing,
+            score=shaper_score, max_accel=max_accel))
+        if best_res is None or best_res.vibrs > results[-1].vibrs:
+            best_res = results[-1]
+    selected = best_res
+    for res in results[::-1]:
+        if res.vibrs < best_res.vibrs * 1.1 and res.score < selected.score:
+            selected = res
+    return selected
+
+def load_data(helper, filename):
+    with open(filename) as f:
+        header = f.readline()
+    if header.startswith('freq,psd_x,psd_y,psd_z,psd_xyz'):
+        data = np.loadtxt(filename, skiprows=1, comments='#', delimiter=',')
+        calibration_data = shaper_calibrate.CalibrationData(
+                freq_bins=data[:,0], psd_sum=data[:,4],
+                psd_x=data[:,1], psd_y=data[:,2], psd_z=data[:,3])
+        calibration_data.set_numpy(np)
+        if 'mzv' not in header:
+            calibration_data.normalize_to_frequencies()
+        return calibration_data
+    data = np.loadtxt(filename, comments='#', delimiter=',')
+    calibration_data = helper.process_accelerometer_data(data)
+    calibration_data.normalize_to_frequencies()
+    return calibration_data
+
+# Generate a frequency response with a couple of resonances
+def gen_data():
+    freq_bins = np.arange(0., 1600., 1.5625)
+    psd = np.zeros(shape=freq_bins.shape)
+    for freq, width, height in [(42., 4., 1.), (61., 6., .3)]:
+        psd += height / (1. + ((freq_bins - freq) / width)**2)
+    calibration_data = shaper_calibrate.CalibrationData(
+            freq_bins=freq_bins, psd_sum=psd.copy(), psd_x=psd.copy(),
+            psd_y=np.zeros(shape=psd.shape), psd_z=np.zeros(shape=psd.shape))
+    calibration_data.set_numpy(np)
+    calibration_data.normalize_to_frequencies()
+    return calibration_data
+
+def main():
+    usage = "%prog [options] [<csv file>]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("--max_smoothing", type="float", dest="max_smoothing",
+                    default=None, help="maximum shaper smoothing to allow")
+    options, args = opts.parse_args()
+    if len(args) > 1:
+        opts.error("Incorrect number of arguments")
+    helper = shaper_calibrate.ShaperCalibrate(printer=None)
+    if args:
+        calibration_data = load_data(helper, args[0])
+    else:
+        calibration_data = gen_data()
+    shaper_cfgs = [shaper_cfg for shaper_cfg in shaper_defs.INPUT_SHAPERS
+                   if shaper_cfg.name in shaper_calibrate.AUTOTUNE_SHAPERS]
+    # Reference (one frequency at a time, one shaper at a time)
+    start_time = time.perf_counter()
+    ref_shapers = [fit_shaper_reference(helper, shaper_cfg, calibration_data,
+                                        options.max_smoothing)
+                   for shaper_cfg in shaper_cfgs]
+    ref_time = time.perf_counter() - start_time
+    # Vectorized, one shaper at a time
+    start_time = time.perf_counter()
+    vec_shapers = [helper.fit_shaper(shaper_cfg, calibration_data,
+                                     options.max_smoothing)
+                   for shaper_cfg in shaper_cfgs]
+    vec_time = time.perf_counter() - start_time
+    # Vectorized, all shapers in parallel
+    start_time = time.perf_counter()
+    best_shaper, par_shapers = helper.find_best_shaper(
+            calibration_data, options.max_smoothing)
+    par_time = time.perf_counter() - start_time
+    for ref, vec, par in zip(ref_shapers, vec_shapers, par_shapers):
+        print("%-8s reference %.1f Hz (%.2f%%, %.0f) vectorized %.1f Hz"
+              " (%.2f%%, %.0f) parallel %.1f Hz (%.2f%%, %.0f)" % (
+                  ref.name, ref.freq, ref.vibrs * 100., ref.max_accel,
+                  vec.freq, vec.vibrs * 100., vec.max_accel,
+                  par.freq, par.vibrs * 100., par.max_accel))
+    print("Best shaper: %s %.1f Hz" % (best_shaper.name, best_shaper.freq))
+    print("Reference:  %.3fs" % (ref_time,))
+    print("Vectorized: %.3fs (%.1fx)" % (vec_time, ref_time / vec_time))
+    print("Parallel:   %.3fs (%.1fx)" % (par_time, ref_time / par_time))
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,8 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import optparse, datetime
+import optparse, datetime, os, array, zipfile
+import numpy
 import matplotlib
 
 MAXBANDWIDTH=25000.
@@ -18,13 +19,49 @@ APPLY_PREFIX = [
     'target', 'temp', 'pwm'
 ]
 
-def parse_log(logname, mcu):
+CACHE_VERSION = 1
+
+def get_cache_filename(logname, mcu):
+    return "%s.stats-%s.npz" % (logname, mcu)
+
+def get_cache_key(logname):
+    st = os.stat(logname)
+    return [CACHE_VERSION, st.st_size, st.st_mtime_ns]
+
+def load_cache(logname, mcu):
+    try:
+        with numpy.load(get_cache_filename(logname, mcu)) as npz:
+            if list(npz['#cachekey']) != get_cache_key(logname):
+                return None
+            return {k: npz[k] for k in npz.files if k != '#cachekey'}
+    except (IOError, OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+
+def save_cache(logname, mcu, data):
+    cache_filename = get_cache_filename(logname, mcu)
+    tmp_filename = cache_filename + ".tmp.npz"
+    try:
+        numpy.savez(tmp_filename, **dict(data, **{
+            '#cachekey': numpy.array(get_cache_key(logname))}))
+        os.rename(tmp_filename, cache_filename)
+    except (IOError, OSError):
+        pass
+
+# Extract the stats into columns (one array per stat name, with nan
+# for samples that do not contain that stat)
+def parse_log(logname, mcu, use_cache=True):
     if mcu is None:
         mcu = "mcu"
+    if use_cache:
+        data = load_cache(logname, mcu)
+        if data is not None:
+            return data
     mcu_prefix = mcu + ":"
     apply_prefix = { p: 1 for p in APPLY_PREFIX }
+    nan = float('nan')
+    columns = {}
+    count = 0
     f = open(logname, 'r')
-    out = []
     for line in f:
         parts = line.split()
         if not parts or parts[0] not in ('Stats', 'INFO:root:Stats'):
@@ -45,10 +82,31 @@ def parse_log(logname, mcu):
             keyparts[name] = val
         if 'print_time' not in keyparts:
             continue
-        keyparts['#sampletime'] = float(parts[1][:-1])
-        out.append(keyparts)
+        keyparts['#sampletime'] = parts[1][:-1]
+        for name in keyparts:
+            if name not in columns:
+                columns[name] = array.array('d', [nan]) * count
+        for name, col in columns.items():
+            val = keyparts.get(name)
+            try:
+                col.append(float(val))
+            except (TypeError, ValueError):
+                col.append(nan)
+        count += 1
     f.close()
-    return out
+    if not count:
+        return None
+    data = {name: numpy.frombuffer(col, dtype=numpy.float64)
+            for name, col in columns.items()}
+    if use_cache:
+        save_cache(logname, mcu, data)
+    return data
+
+def get_column(data, name, default=0.):
+    col = data.get(name)
+    if col is None:
+        return numpy.full(len(data['#sampletime']), default)
+    return numpy.where(numpy.isnan(col), default, col)
 
 def setup_matplotlib(output_to_file):
     global matplotlib
@@ -61,10 +119,13 @@ def find_print_restarts(data):
     runoff_samples = {}
     last_runoff_start = last_buffer_time = last_sampletime = 0.
     last_print_stall = 0
-    for d in reversed(data):
+    sampletimes = data['#sampletime'].tolist()
+    buffer_times = get_column(data, 'buffer_time').tolist()
+    print_stalls = data['print_stall'].tolist()
+    for i in reversed(range(len(sampletimes))):
         # Check for buffer runoff
-        sampletime = d['#sampletime']
-        buffer_time = float(d.get('buffer_time', 0.))
+        sampletime = sampletimes[i]
+        buffer_time = buffer_times[i]
         if (last_runoff_start and last_sampletime - sampletime < 5
             and buffer_time > last_buffer_time):
             runoff_samples[last_runoff_start][1].append(sampletime)
@@ -76,7 +137,7 @@ def find_print_restarts(data):
         last_buffer_time = buffer_time
         last_sampletime = sampletime
         # Check for print stall
-        print_stall = int(d['print_stall'])
+        print_stall = int(print_stalls[i])
         if print_stall < last_print_stall:
             if last_runoff_start:
                 runoff_samples[last_runoff_start][0] = True
@@ -87,28 +148,31 @@ def find_print_restarts(data):
 
 def plot_mcu(data, maxbw):
     # Generate data for plot
-    basetime = lasttime = data[0]['#sampletime']
-    lastbw = float(data[0]['bytes_write']) + float(data[0]['bytes_retransmit'])
+    sampletimes = data['#sampletime'].tolist()
+    bws = (data['bytes_write'] + data['bytes_retransmit']).tolist()
+    mcu_loads = (data['mcu_task_avg'] + 3*data['mcu_task_stddev']).tolist()
+    buffer_times = data['buffer_time'].tolist()
+    mcu_awakes = get_column(data, 'mcu_awake').tolist()
+    basetime = lasttime = sampletimes[0]
+    lastbw = bws[0]
     sample_resets = find_print_restarts(data)
     times = []
     bwdeltas = []
     loads = []
     awake = []
     hostbuffers = []
-    for d in data:
-        st = d['#sampletime']
+    for i, st in enumerate(sampletimes):
         timedelta = st - lasttime
         if timedelta <= 0.:
             continue
-        bw = float(d['bytes_write']) + float(d['bytes_retransmit'])
+        bw = bws[i]
         if bw < lastbw:
             lastbw = bw
             continue
-        load = float(d['mcu_task_avg']) + 3*float(d['mcu_task_stddev'])
+        load = mcu_loads[i]
         if st - basetime < 15.:
             load = 0.
-        pt = float(d['print_time'])
-        hb = float(d['buffer_time'])
+        hb = buffer_times[i]
         if hb >= MAXBUFFER or st in sample_resets:
             hb = 0.
         else:
@@ -117,7 +181,7 @@ def plot_mcu(data, maxbw):
         times.append(datetime.datetime.utcfromtimestamp(st))
         bwdeltas.append(100. * (bw - lastbw) / (maxbw * timedelta))
         loads.append(100. * load / TASK_MAX)
-        awake.append(100. * float(d.get('mcu_awake', 0.)) / STATS_INTERVAL)
+        awake.append(100. * mcu_awakes[i] / STATS_INTERVAL)
         lasttime = st
         lastbw = bw
 
@@ -139,25 +203,28 @@ def plot_mcu(data, maxbw):
 
 def plot_system(data):
     # Generate data for plot
-    lasttime = data[0]['#sampletime']
-    lastcputime = float(data[0]['cputime'])
+    sampletimes = data['#sampletime'].tolist()
+    all_cputimes = data['cputime'].tolist()
+    all_sysloads = data['sysload'].tolist()
+    all_memavails = data['memavail'].tolist()
+    lasttime = sampletimes[0]
+    lastcputime = all_cputimes[0]
     times = []
     sysloads = []
     cputimes = []
     memavails = []
-    for d in data:
-        st = d['#sampletime']
+    for i, st in enumerate(sampletimes):
         timedelta = st - lasttime
         if timedelta <= 0.:
             continue
         lasttime = st
         times.append(datetime.datetime.utcfromtimestamp(st))
-        cputime = float(d['cputime'])
+        cputime = all_cputimes[i]
         cpudelta = max(0., min(1.5, (cputime - lastcputime) / timedelta))
         lastcputime = cputime
         cputimes.append(cpudelta * 100.)
-        sysloads.append(float(d['sysload']) * 100.)
-        memavails.append(float(d['memavail']))
+        sysloads.append(all_sysloads[i] * 100.)
+        memavails.append(all_memavails[i])
 
     # Build plot
     fig, ax1 = matplotlib.pyplot.subplots()
@@ -181,20 +248,17 @@ def plot_system(data):
     ax1.grid(True)
     return fig
 
+def get_frequency_samples(data, key):
+    values = data[key]
+    valid = ~numpy.isnan(values) & (values != 0.) & (values != 1.)
+    times = [datetime.datetime.utcfromtimestamp(st)
+             for st in data['#sampletime'][valid].tolist()]
+    return times, values[valid].tolist()
+
 def plot_mcu_frequencies(data):
-    all_keys = {}
-    for d in data:
-        all_keys.update(d)
-    graph_keys = { key: ([], []) for key in all_keys
+    graph_keys = { key: get_frequency_samples(data, key) for key in data
                    if (key in ("freq", "adj")
                        or (key.endswith(":freq") or key.endswith(":adj"))) }
-    for d in data:
-        st = datetime.datetime.utcfromtimestamp(d['#sampletime'])
-        for key, (times, values) in graph_keys.items():
-            val = d.get(key)
-            if val not in (None, '0', '1'):
-                times.append(st)
-                values.append(float(val))
     est_mhz = { key: round((sum(values)/len(values)) / 1000000.)
                 for key, (times, values) in graph_keys.items() }
 
@@ -218,18 +282,8 @@ def plot_mcu_frequencies(data):
     return fig
 
 def plot_mcu_frequency(data, mcu):
-    all_keys = {}
-    for d in data:
-        all_keys.update(d)
-    graph_keys = { key: ([], []) for key in all_keys
+    graph_keys = { key: get_frequency_samples(data, key) for key in data
                    if key in ("freq", "adj") }
-    for d in data:
-        st = datetime.datetime.utcfromtimestamp(d['#sampletime'])
-        for key, (times, values) in graph_keys.items():
-            val = d.get(key)
-            if val not in (None, '0', '1'):
-                times.append(st)
-                values.append(float(val))
 
     # Build plot
     fig, ax1 = matplotlib.pyplot.subplots()
@@ -259,14 +313,13 @@ def plot_temperature(data, heaters):
         temps = []
         targets = []
         pwm = []
-        for d in data:
-            temp = d.get(temp_key)
-            if temp is None:
-                continue
-            times.append(datetime.datetime.utcfromtimestamp(d['#sampletime']))
-            temps.append(float(temp))
-            pwm.append(float(d.get(pwm_key, 0.)))
-            targets.append(float(d.get(target_key, 0.)))
+        if temp_key in data:
+            valid = ~numpy.isnan(data[temp_key])
+            times = [datetime.datetime.utcfromtimestamp(st)
+                     for st in data['#sampletime'][valid].tolist()]
+            temps = data[temp_key][valid].tolist()
+            pwm = get_column(data, pwm_key)[valid].tolist()
+            targets = get_column(data, target_key)[valid].tolist()
         ax1.plot_date(times, temps, '-', label='%s temp' % (heater,), alpha=0.8)
         if any(targets):
             label = '%s target' % (heater,)
@@ -302,14 +355,16 @@ def main():
                     default=None, help="graph heater temperature")
     opts.add_option("-m", "--mcu", type="string", dest="mcu", default=None,
                     help="limit stats to the given mcu")
+    opts.add_option("--nocache", action="store_false", dest="use_cache",
+                    default=True, help="do not read or write the stats cache")
     options, args = opts.parse_args()
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
     logname = args[0]
 
     # Parse data
-    data = parse_log(logname, options.mcu)
-    if not data:
+    data = parse_log(logname, options.mcu, options.use_cache)
+    if data is None:
         return
 
     # Draw graph
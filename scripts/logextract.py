@@ -4,7 +4,7 @@
 # Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, re, collections, ast
+import sys, re, collections, ast, optparse, bisect, gzip
 
 def format_comment(line_num, line):
     return "# %6d: %s" % (line_num, line)
@@ -567,44 +567,206 @@ class GatherShutdown:
 
 
 ######################################################################
-# Startup
+# Log indexing
 ######################################################################
 
-def main():
-    logname = sys.argv[1]
-    last_git = last_start = None
-    configs = {}
-    handler = None
-    recent_lines = collections.deque([], 200)
-    # Parse log file
+INDEX_READ_SIZE = 4 * 1024 * 1024
+RECENT_LINES = 200
+
+# Open a log file (possibly gzip compressed)
+def open_log(logname):
     f = open(logname, 'rb')
-    for line_num, line in enumerate(f):
-        line = line.rstrip()
-        line_num += 1
-        recent_lines.append((line_num, line))
-        if handler is not None:
-            ret = handler.add_line(line_num, line)
+    magic = f.read(2)
+    f.seek(0)
+    if magic == b'\x1f\x8b':
+        f.close()
+        return gzip.open(logname, 'rb')
+    return f
+
+# Categorize the lines that the main extraction loop acts upon
+def classify_line(line):
+    if line.startswith('Git version'):
+        return 'git'
+    elif line.startswith('Start printer at'):
+        return 'start'
+    elif line == '===== Config file =====':
+        return 'config'
+    elif 'shutdown: ' in line or line.startswith('Dumping '):
+        return 'shutdown'
+    return None
+
+index_patterns = [b'\nGit version', b'\nStart printer at',
+                  b'===== Config file =====', b'shutdown: ', b'\nDumping ']
+
+# Scan a log for markers using bulk searches over large blocks.  The
+# resulting index holds the line number and contents of each marker
+# along with (line_num, file_offset) checkpoints that allow seeking.
+class LogIndex:
+    def __init__(self):
+        self.events = []
+        self.checkpoints = []
+    def _scan_block(self, data, line_num):
+        # Find the start of every line containing a possible marker
+        starts = set()
+        for pattern in index_patterns:
+            pos = data.find(pattern)
+            while pos >= 0:
+                starts.add(data.rfind(b'\n', 0, pos + 1) + 1)
+                pos = data.find(pattern, pos + 1)
+        starts.add(0)
+        # Verify the marker and determine its line number
+        prev_start = 0
+        for start in sorted(starts):
+            line_num += data.count(b'\n', prev_start, start)
+            prev_start = start
+            line = data[start:data.find(b'\n', start)].rstrip()
+            kind = classify_line(line)
+            if kind is not None:
+                self.events.append((line_num, kind, line))
+    def build(self, f):
+        partial_input = b''
+        offset = 0
+        line_num = 1
+        while 1:
+            data = f.read(INDEX_READ_SIZE)
+            if not data:
+                if partial_input:
+                    self._scan_block(partial_input + b'\n', line_num)
+                break
+            data = partial_input + data
+            end = data.rfind(b'\n') + 1
+            partial_input = data[end:]
+            if not end:
+                continue
+            data = data[:end]
+            self.checkpoints.append((line_num, offset))
+            self._scan_block(data, line_num)
+            line_num += data.count(b'\n')
+            offset += len(data)
+
+# Line reader that can skip ahead using the index checkpoints
+class IndexedReader:
+    def __init__(self, f, checkpoints):
+        self.f = f
+        self.checkpoints = checkpoints
+        self.checkpoint_lines = [cp[0] for cp in checkpoints]
+        self.line_num = 1
+    def skip_to(self, line_num):
+        i = bisect.bisect_right(self.checkpoint_lines, line_num) - 1
+        if i >= 0 and self.checkpoints[i][0] > self.line_num:
+            self.line_num, offset = self.checkpoints[i]
+            self.f.seek(offset)
+        while self.line_num < line_num:
+            if not self.f.readline():
+                break
+            self.line_num += 1
+    def readline(self):
+        line = self.f.readline()
+        if not line:
+            return None, None
+        self.line_num += 1
+        return self.line_num - 1, line.rstrip()
+
+
+######################################################################
+# Startup
+######################################################################
+
+class LogExtract:
+    def __init__(self, logname):
+        self.logname = logname
+        self.last_git = self.last_start = None
+        self.configs = {}
+        self.handler = None
+        self.recent_lines = collections.deque([], RECENT_LINES)
+    def parse_line(self, line_num, line):
+        self.recent_lines.append((line_num, line))
+        if self.handler is not None:
+            ret = self.handler.add_line(line_num, line)
             if ret:
+                return
+            self.recent_lines.clear()
+            self.handler = None
+        kind = classify_line(line)
+        if kind == 'git':
+            self.last_git = format_comment(line_num, line)
+        elif kind == 'start':
+            self.last_start = format_comment(line_num, line)
+        elif kind == 'config':
+            self.handler = GatherConfig(self.configs, line_num,
+                                        self.recent_lines, self.logname)
+            self.handler.add_comment(self.last_git)
+            self.handler.add_comment(self.last_start)
+        elif kind == 'shutdown':
+            self.handler = GatherShutdown(self.configs, line_num,
+                                          self.recent_lines, self.logname)
+            self.handler.add_comment(self.last_git)
+            self.handler.add_comment(self.last_start)
+    def parse_file(self, f):
+        for line_num, line in enumerate(f):
+            self.parse_line(line_num + 1, line.rstrip())
+    def parse_indexed(self, f):
+        # Index the log and then only parse the regions near markers
+        index = LogIndex()
+        index.build(f)
+        f.seek(0)
+        reader = IndexedReader(f, index.checkpoints)
+        for line_num, kind, line in index.events:
+            if line_num < reader.line_num:
+                # Already handled while parsing an earlier region
                 continue
-            recent_lines.clear()
-            handler = None
-        if line.startswith('Git version'):
-            last_git = format_comment(line_num, line)
-        elif line.startswith('Start printer at'):
-            last_start = format_comment(line_num, line)
-        elif line == '===== Config file =====':
-            handler = GatherConfig(configs, line_num, recent_lines, logname)
-            handler.add_comment(last_git)
-            handler.add_comment(last_start)
-        elif 'shutdown: ' in line or line.startswith('Dumping '):
-            handler = GatherShutdown(configs, line_num, recent_lines, logname)
-            handler.add_comment(last_git)
-            handler.add_comment(last_start)
-    if handler is not None:
-        handler.finalize()
-    # Write found config files
-    for cfg in configs.values():
-        cfg.write_file()
+            if kind == 'git':
+                self.last_git = format_comment(line_num, line)
+                continue
+            elif kind == 'start':
+                self.last_start = format_comment(line_num, line)
+                continue
+            # Load the lines leading up to the marker
+            start_line = max(reader.line_num, line_num - RECENT_LINES + 1)
+            if start_line > reader.line_num:
+                self.recent_lines.clear()
+            reader.skip_to(start_line)
+            while reader.line_num < line_num:
+                recent_line = reader.readline()
+                if recent_line[0] is None:
+                    return
+                self.recent_lines.append(recent_line)
+            # Parse until the handler for this region completes
+            while 1:
+                line_num, line = reader.readline()
+                if line_num is None:
+                    return
+                self.parse_line(line_num, line)
+                if self.handler is None:
+                    break
+    def finalize(self):
+        if self.handler is not None:
+            self.handler.finalize()
+            self.handler = None
+        # Write found config files
+        for cfg in self.configs.values():
+            cfg.write_file()
+
+def main():
+    usage = "%prog [options] <logfile>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-s", "--stream", action="store_true", dest="stream",
+                    help="index the log and only parse regions near"
+                    " shutdowns and config blocks")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    logname = args[0]
+    if logname.endswith('.gz'):
+        logname = logname[:-3]
+    extract = LogExtract(logname)
+    f = open_log(args[0])
+    if options.stream:
+        extract.parse_indexed(f)
+    else:
+        extract.parse_file(f)
+    f.close()
+    extract.finalize()
 
 if __name__ == '__main__':
     main()
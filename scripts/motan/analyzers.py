@@ -3,8 +3,12 @@
 # Copyright (C) 2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, collections
+import math, collections, multiprocessing
 import readlog
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 ######################################################################
@@ -41,6 +45,9 @@ class GenDerivative:
     def generate_data(self):
         inv_seg_time = 1. / self.amanager.get_segment_time()
         data = self.amanager.get_datasets()[self.source]
+        if numpy is not None:
+            deriv = numpy.diff(data) * inv_seg_time
+            return numpy.concatenate((deriv[:1], deriv))
         deriv = [(data[i+1] - data[i]) * inv_seg_time
                  for i in range(len(data)-1)]
         return [deriv[0]] + deriv
@@ -85,11 +92,19 @@ class GenIntegral:
     def generate_data(self):
         seg_time = self.amanager.get_segment_time()
         src = self.amanager.get_datasets()[self.source]
-        offset = sum(src) / len(src)
+        if numpy is not None:
+            offset = numpy.mean(src)
+            if self.ref is None:
+                return numpy.cumsum((src - offset) * seg_time)
+            src = src.tolist()
+        else:
+            offset = sum(src) / len(src)
         total = 0.
         ref = None
         if self.ref is not None:
             ref = self.amanager.get_datasets()[self.ref]
+            if numpy is not None:
+                ref = ref.tolist()
             offset -= (ref[-1] - ref[0]) / (len(src) * seg_time)
             total = ref[0]
             src_weight = 1.
@@ -102,6 +117,9 @@ class GenIntegral:
             if ref is not None:
                 total = src_weight * total + ref_weight * ref[i]
             data[i] = total
+        if numpy is not None:
+            # Other generators may use this output as a numpy dataset
+            return numpy.array(data)
         return data
 AHandlers["integral"] = GenIntegral
 
@@ -140,11 +158,15 @@ class GenKinematicPosition:
         datasets = self.amanager.get_datasets()
         data1 = datasets[self.source1]
         data2 = datasets[self.source2]
+        if numpy is not None:
+            return data1 + data2
         return [d1 + d2 for d1, d2 in zip(data1, data2)]
     def generate_data_corexy_minus(self):
         datasets = self.amanager.get_datasets()
         data1 = datasets[self.source1]
         data2 = datasets[self.source2]
+        if numpy is not None:
+            return data1 - data2
         return [d1 - d2 for d1, d2 in zip(data1, data2)]
     def generate_data_passthrough(self):
         return self.amanager.get_datasets()[self.source1]
@@ -173,6 +195,10 @@ class GenCorexyPosition:
         datasets = self.amanager.get_datasets()
         data1 = datasets[self.source1]
         data2 = datasets[self.source2]
+        if numpy is not None:
+            if self.is_plus:
+                return .5 * (data1 + data2)
+            return .5 * (data1 - data2)
         if self.is_plus:
             return [.5 * (d1 + d2) for d1, d2 in zip(data1, data2)]
         return [.5 * (d1 - d2) for d1, d2 in zip(data1, data2)]
@@ -201,6 +227,8 @@ class GenDeviation:
         datasets = self.amanager.get_datasets()
         data1 = datasets[self.source1]
         data2 = datasets[self.source2]
+        if numpy is not None:
+            return data1 - data2
         return [d1 - d2 for d1, d2 in zip(data1, data2)]
 AHandlers["deviation"] = GenDeviation
 
@@ -216,6 +244,15 @@ def list_datasets():
         datasets += AHandlers[ah].DataSets
     return datasets
 
+# Generate a raw dataset in a worker process (using a private log reader)
+def _generate_raw_dataset(args):
+    log_prefix, seek_time, name, times = args
+    lmanager = readlog.LogManager(log_prefix)
+    lmanager.setup_index()
+    lmanager.seek_time(seek_time)
+    hdl = lmanager.setup_dataset(name)
+    return [hdl.pull_data(t) for t in times]
+
 # Manage raw and generated data samples
 class AnalyzerManager:
     error = None
@@ -228,8 +265,11 @@ class AnalyzerManager:
         self.datasets = {}
         self.dataset_times = []
         self.duration = 5.
+        self.jobs = 1
     def set_duration(self, duration):
         self.duration = duration
+    def set_jobs(self, jobs):
+        self.jobs = jobs
     def get_segment_time(self):
         return self.segment_time
     def get_datasets(self):
@@ -266,18 +306,43 @@ class AnalyzerManager:
             if hdl is None:
                 raise self.error("Unknown dataset '%s'" % (dataset,))
         return hdl.get_label()
+    def _generate_raw_parallel(self, times):
+        # Each raw dataset is read from the log by a separate process
+        lmanager = self.lmanager
+        start_time = lmanager.get_start_time()
+        seek_time = start_time - lmanager.get_initial_start_time()
+        names = list(self.raw_datasets.keys())
+        args = [(lmanager.get_log_prefix(), seek_time, name, times)
+                for name in names]
+        pool = multiprocessing.Pool(min(self.jobs, len(names)))
+        try:
+            results = pool.map(_generate_raw_dataset, args)
+        finally:
+            pool.close()
+            pool.join()
+        for name, data in zip(names, results):
+            self.datasets[name] = data
     def generate_datasets(self):
         # Generate raw data
-        list_hdls = [(self.datasets[name], hdl)
-                     for name, hdl in self.raw_datasets.items()]
         initial_start_time = self.lmanager.get_initial_start_time()
         start_time = t = self.lmanager.get_start_time()
         end_time = start_time + self.duration
+        times = []
         while t < end_time:
             t += self.segment_time
-            self.dataset_times.append(t - initial_start_time)
-            for dl, hdl in list_hdls:
-                dl.append(hdl.pull_data(t))
+            times.append(t)
+        self.dataset_times = [t - initial_start_time for t in times]
+        if self.jobs > 1 and len(self.raw_datasets) > 1:
+            self._generate_raw_parallel(times)
+        else:
+            list_hdls = [(self.datasets[name], hdl)
+                         for name, hdl in self.raw_datasets.items()]
+            for t in times:
+                for dl, hdl in list_hdls:
+                    dl.append(hdl.pull_data(t))
+        if numpy is not None:
+            for name in self.raw_datasets:
+                self.datasets[name] = numpy.array(self.datasets[name])
         # Generate analyzer data
         for name, hdl in self.gen_datasets.items():
             self.datasets[name] = hdl.generate_data()
@@ -4,9 +4,11 @@
 # Copyright (C) 2020-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, os, optparse, socket, select, json, errno, time, zlib
+import sys, os, optparse, socket, select, json, errno, time, zlib, struct
 
 INDEX_UPDATE_TIME = 5.0
+KEYFRAME_UPDATE_TIME = 60.0
+KEYFRAME_FORMAT = "<dQ"
 ClientInfo = {'program': 'motan_data_logger', 'version': 'v0.1'}
 
 def webhook_socket_create(uds_filename):
@@ -53,7 +55,7 @@ class LogWriter:
         self.comp = None
 
 class DataLogger:
-    def __init__(self, uds_filename, log_prefix):
+    def __init__(self, uds_filename, log_prefix, binary=False):
         # IO
         self.webhook_socket = webhook_socket_create(uds_filename)
         self.poll = select.poll()
@@ -62,12 +64,19 @@ class DataLogger:
         # Data log
         self.logger = LogWriter(log_prefix + ".json.gz")
         self.index = LogWriter(log_prefix + ".index.gz")
+        self.keyframes = open(log_prefix + ".keyframes", "wb")
         # Handlers
         self.query_handlers = {}
         self.async_handlers = {}
         # get_status databasing
         self.db = {}
         self.next_index_time = 0.
+        self.full_status = {}
+        self.next_keyframe_time = 0.
+        # Request packed encoding of stepper and trapq data
+        self.dump_params = {}
+        if binary:
+            self.dump_params["encoding"] = "binary"
         # Start login process
         self.send_query("info", "info", {"client_info": ClientInfo},
                         self.handle_info)
@@ -77,6 +86,7 @@ class DataLogger:
         self.error(msg)
         self.logger.close()
         self.index.close()
+        self.keyframes.close()
         sys.exit(0)
     # Unix Domain Socket IO
     def send_query(self, msg_id, method, params, cb):
@@ -141,15 +151,19 @@ class DataLogger:
     def handle_subscribe(self, msg, raw_msg):
         result = msg["result"]
         self.next_index_time = result["eventtime"] + INDEX_UPDATE_TIME
+        self.next_keyframe_time = result["eventtime"] + KEYFRAME_UPDATE_TIME
         self.db["status"] = status = result["status"]
+        self.full_status = {k: dict(v) for k, v in status.items()}
         # Subscribe to trapq and stepper queue updates
         motion_report = status.get("motion_report", {})
         for trapq in motion_report.get("trapq", []):
+            params = dict(self.dump_params, name=trapq)
             self.send_subscribe("trapq:" + trapq, "motion_report/dump_trapq",
-                                {"name": trapq})
+                                params)
         for stepper in motion_report.get("steppers", []):
+            params = dict(self.dump_params, name=stepper)
             self.send_subscribe("stepq:" + stepper,
-                                "motion_report/dump_stepper", {"name": stepper})
+                                "motion_report/dump_stepper", params)
         # Subscribe to additional sensor data
         config = status["configfile"]["settings"]
         for cfgname in config.keys():
@@ -168,19 +182,37 @@ class DataLogger:
                        % (msg_id, msg.get("error", {}).get("message", "")))
             return
         self.db.setdefault("subscriptions", {})[msg_id] = msg["result"]
-    def flush_index(self):
+    def flush_index(self, is_keyframe=False):
         self.db['file_position'] = self.logger.flush()
+        if is_keyframe:
+            # Store the full status so readers can start from this entry
+            status = self.full_status
+            self.db['status'] = {k: dict(v) for k, v in status.items()}
+            self.db['keyframe'] = True
+            th = status.get('toolhead', {})
+            ptime = max(th.get('estimated_print_time', 0.),
+                        th.get('print_time', 0.))
+            self.keyframes.write(struct.pack(KEYFRAME_FORMAT, ptime,
+                                             self.index.file_pos))
+            self.keyframes.flush()
         self.index.add_data(json.dumps(self.db, separators=(',', ':')).encode())
+        # Each index entry is an independently decodable block
+        self.index.flush()
         self.db = {"status": {}}
     def handle_async_db(self, msg, raw_msg):
         params = msg["params"]
         db_status = self.db['status']
+        full_status = self.full_status
         for k, v in params.get("status", {}).items():
             db_status.setdefault(k, {}).update(v)
+            full_status.setdefault(k, {}).update(v)
         eventtime = params['eventtime']
         if eventtime >= self.next_index_time:
             self.next_index_time = eventtime + INDEX_UPDATE_TIME
-            self.flush_index()
+            is_keyframe = eventtime >= self.next_keyframe_time
+            if is_keyframe:
+                self.next_keyframe_time = eventtime + KEYFRAME_UPDATE_TIME
+            self.flush_index(is_keyframe)
 
 def nice():
     try:
@@ -192,12 +224,15 @@ def nice():
 def main():
     usage = "%prog [options] <socket filename> <log name>"
     opts = optparse.OptionParser(usage)
+    opts.add_option("-b", "--binary", action="store_true", dest="binary",
+                    default=False,
+                    help="use packed binary encoding for motion data")
     options, args = opts.parse_args()
     if len(args) != 2:
         opts.error("Incorrect number of arguments")
 
     nice()
-    dl = DataLogger(args[0], args[1])
+    dl = DataLogger(args[0], args[1], options.binary)
     dl.run()
 
 if __name__ == '__main__':
@@ -106,6 +106,8 @@ def main():
                     help="Number of seconds to graph")
     opts.add_option("--segment-time", type="float", default=0.000100,
                     help="Analysis segment time (default 0.000100 seconds)")
+    opts.add_option("-j", "--jobs", type="int", default=1,
+                    help="Number of processes used to read datasets")
     opts.add_option("-g", "--graph", help="Graph to generate (python literal)")
     opts.add_option("-l", "--list-datasets", action="store_true",
                     help="List available datasets")
@@ -122,6 +124,7 @@ def main():
     lmanager.seek_time(options.skip)
     amanager = analyzers.AnalyzerManager(lmanager, options.segment_time)
     amanager.set_duration(options.duration)
+    amanager.set_jobs(options.jobs)
 
     # Default graphs to draw
     graph_descs = [
@@ -3,7 +3,7 @@
 # Copyright (C) 2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import json, zlib
+import json, zlib, struct, base64, bisect, os
 
 class error(Exception):
     pass
@@ -444,6 +444,27 @@ LogHandlers["angle"] = HandleAngle
 # Log reading
 ######################################################################
 
+# Decoding of the packed "binary" encoding of motion_report dump messages
+def _decode_bdata(params):
+    return zlib.decompress(base64.b64decode(params.pop('bdata')))
+
+def decode_stepq_binary(params):
+    packed = _decode_bdata(params)
+    count = len(packed) // 12
+    vals = struct.unpack("<%di" % (count * 3,), packed)
+    params['data'] = list(zip(vals[:count], vals[count:2*count],
+                              vals[2*count:]))
+
+def decode_trapq_binary(params):
+    packed = _decode_bdata(params)
+    count = len(packed) // 80
+    vals = struct.unpack("<%dd" % (count * 10,), packed)
+    cols = [vals[i*count:(i+1)*count] for i in range(10)]
+    params['data'] = [(pt, mt, sv, a, (sx, sy, sz), (xr, yr, zr))
+                      for pt, mt, sv, a, sx, sy, sz, xr, yr, zr in zip(*cols)]
+
+BinaryDecoders = {'stepq': decode_stepq_binary, 'trapq': decode_trapq_binary}
+
 # Read, uncompress, and parse messages in a log built by data_logger.py
 class JsonLogReader:
     def __init__(self, filename):
@@ -453,6 +474,7 @@ class JsonLogReader:
     def seek(self, pos):
         self.file.seek(pos)
         self.comp = zlib.decompressobj(-15)
+        self.msgs = [b""]
     def pull_msg(self):
         msgs = self.msgs
         while 1:
@@ -472,6 +494,18 @@ class JsonLogReader:
             parts[0] = msgs[0] + parts[0]
             self.msgs = msgs = parts
 
+# Load the table of (print_time, index_file_position) of index keyframes
+KEYFRAME_FORMAT = "<dQ"
+
+def load_keyframes(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename, "rb") as f:
+        data = f.read()
+    size = struct.calcsize(KEYFRAME_FORMAT)
+    return [struct.unpack_from(KEYFRAME_FORMAT, data, pos)
+            for pos in range(0, len(data) - size + 1, size)]
+
 # Store messages in per-subscription queues until handlers are ready for them
 class JsonDispatcher:
     def __init__(self, log_prefix):
@@ -501,7 +535,10 @@ class JsonDispatcher:
                 pt = json_msg.get('toolhead', {}).get('estimated_print_time')
                 if pt is not None:
                     self.last_read_time = pt
-            for mq in self.queues.get(qid, []):
+            mqs = self.queues.get(qid, [])
+            if mqs and 'bdata' in json_msg['params']:
+                BinaryDecoders[qid.split(':')[0]](json_msg['params'])
+            for mq in mqs:
                 mq.append(json_msg['params'])
 
 
@@ -566,7 +603,9 @@ def list_datasets():
 class LogManager:
     error = error
     def __init__(self, log_prefix):
+        self.log_prefix = log_prefix
         self.index_reader = JsonLogReader(log_prefix + ".index.gz")
+        self.keyframes = load_keyframes(log_prefix + ".keyframes")
         self.jdispatch = JsonDispatcher(log_prefix)
         self.initial_start_time = self.start_time = 0.
         self.datasets = {}
@@ -581,6 +620,8 @@ class LogManager:
         start_time = status['toolhead']['estimated_print_time']
         self.initial_start_time = self.start_time = start_time
         self.log_subscriptions = fmsg.get('subscriptions', {})
+    def get_log_prefix(self):
+        return self.log_prefix
     def get_initial_status(self):
         return self.initial_status
     def available_dataset_types(self):
@@ -592,6 +633,11 @@ class LogManager:
         start_status = self.start_status
         seek_time = max(self.initial_start_time, req_start_time - 1.)
         file_position = 0
+        # Skip directly to the last keyframe (full status) before seek_time
+        kf_times = [kf[0] for kf in self.keyframes]
+        kf_idx = bisect.bisect_right(kf_times, seek_time) - 1
+        if kf_idx >= 0:
+            self.index_reader.seek(self.keyframes[kf_idx][1])
         while 1:
             fmsg = self.index_reader.pull_msg()
             if fmsg is None: